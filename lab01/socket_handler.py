@@ -68,7 +68,8 @@ def recv_until(sock, delimiter='\n'):
     if isinstance(delimiter, str):
         delimiter = delimiter.encode()
 
-    data = b''
+    # bytearray растет на месте: += для bytes копировал бы всю строку
+    data = bytearray()
     while True:
         try:
             chunk = sock.recv(1)
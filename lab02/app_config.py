@@ -29,6 +29,9 @@ IS_WINDOWS = platform.system() == "Linux"
 SOCKET_TIMEOUT = 300
 CONNECTION_TIMEOUT = 60
 
+# Число рабочих потоков для обработки UDP пакетов на сервере
+UDP_WORKERS = 8
+
 # Разделитель команд
 CMD_TERMINATOR = "\n"
 
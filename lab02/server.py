@@ -8,8 +8,8 @@ import threading
 import os
 import shutil
 import select
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from unittest import result
 
 from app_config import *
 from socket_handler import set_keepalive, recv_until, recv_exact, send_all
@@ -538,6 +538,10 @@ class Server:
         self.running = False
         self.tcp_socket = None
         self.udp_socket = None
+        # Пакеты обрабатываются пулом, а не новым потоком на каждый пакет
+        self.udp_workers = ThreadPoolExecutor(
+            max_workers=UDP_WORKERS, thread_name_prefix="udp"
+        )
 
         # Инициализация обработчиков
         self.tcp_handler = TCPServerHandler(self)
@@ -609,12 +613,9 @@ class Server:
         while self.running:
             try:
                 data, client_addr = self.udp_socket.recvfrom(65535)
-                # Обрабатываем в отдельном потоке
-                thread = threading.Thread(
-                    target=self.udp_handler.handle_packet, args=(data, client_addr)
+                self.udp_workers.submit(
+                    self.udp_handler.handle_packet, data, client_addr
                 )
-                thread.daemon = True
-                thread.start()
             except socket.timeout:
                 continue
             except Exception as e:
@@ -628,6 +629,7 @@ class Server:
             self.tcp_socket.close()
         if self.udp_socket:
             self.udp_socket.close()
+        self.udp_workers.shutdown(wait=False)
         print("Сервер остановлен")
 
 
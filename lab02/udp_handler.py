@@ -9,6 +9,8 @@ from app_config import BUFFER_SIZE
 # Заголовок пакета: magic(2) + packet_id(4) + total_packets(4) + flags(1) + data_size(2)
 PACKET_HEADER_FORMAT = '!HIIBH'
 PACKET_HEADER_SIZE = struct.calcsize(PACKET_HEADER_FORMAT)
+# Формат разбирается один раз, а не при каждом struct.pack/unpack
+PACKET_HEADER = struct.Struct(PACKET_HEADER_FORMAT)
 MAGIC = 0xDEAD
 
 # Флаги пакета
@@ -28,14 +30,7 @@ def create_packet(packet_id, total_packets, flags, data=b''):
     Создание пакета с заголовком
     Формат: [magic(2)][packet_id(4)][total_packets(4)][flags(1)][data_size(2)][data]
     """
-    header = struct.pack(
-        PACKET_HEADER_FORMAT,
-        MAGIC,
-        packet_id,
-        total_packets,
-        flags,
-        len(data)
-    )
+    header = PACKET_HEADER.pack(MAGIC, packet_id, total_packets, flags, len(data))
     return header + data
 
 
@@ -46,8 +41,8 @@ def parse_packet(packet):
         return None
 
     try:
-        header = packet[:PACKET_HEADER_SIZE]
-        magic, packet_id, total_packets, flags, data_size = struct.unpack(PACKET_HEADER_FORMAT, header)
+        # unpack_from читает заголовок на месте, без среза-копии
+        magic, packet_id, total_packets, flags, data_size = PACKET_HEADER.unpack_from(packet)
 
         if magic != MAGIC:
             print(f"Неверное магическое число: {magic} != {MAGIC}")
@@ -10,6 +10,20 @@ SERVER_HOST = "0.0.0.0"
 SERVER_PORT = 12345
 BUFFER_SIZE = 8192
 
+# Размеры буферов TCP сокетов в ядре (байт), ядро ограничивает их
+# значениями net.core.wmem_max / net.core.rmem_max
+TCP_SNDBUF = 4 * 1024 * 1024
+TCP_RCVBUF = 4 * 1024 * 1024
+
+# Размер блока приема файла в TCP клиенте (байт)
+TCP_CHUNK_SIZE = 64 * 1024
+
+# Буфер записи скачиваемого по TCP файла (байт)
+FILE_WRITE_BUFFER = 1024 * 1024
+
+# Порция файла за один вызов sendfile при TCP загрузке (байт)
+SENDFILE_CHUNK = 4 * 1024 * 1024
+
 # Настройки Keep-Alive (в секундах)
 KEEPALIVE_IDLE = 30
 KEEPALIVE_INTERVAL = 5
@@ -4,18 +4,46 @@ TCP/UDP клиент для передачи файлов с поддержко
 """
 import socket
 import os
+import heapq
+import mmap
+import select
 import time
 import signal
 import sys
 import threading
+from array import array
 
 from app_config import *
-from socket_handler import set_keepalive, recv_until, recv_exact, send_all
-from file_handler import ensure_dirs, get_file_size, get_partial_size, FileTransferStats
+from socket_handler import (
+    set_keepalive,
+    recv_until,
+    recv_exact_into,
+    send_all,
+    send_file,
+    cork,
+    create_socket,
+    connect_socket,
+)
+from file_handler import (
+    ensure_dirs,
+    get_file_size,
+    get_partial_size,
+    format_bytes,
+    preallocate_file,
+    write_at,
+    FileTransferStats,
+)
 from udp_handler import *
 from sliding_window import SlidingWindow, ReceiveWindow
 
 
+def _print_progress(text):
+    """Вывод строки прогресса поверх предыдущей (в stderr, без print)"""
+    if SHOW_PROGRESS_BAR:
+        sys.stderr.write("\r" + text)
+        sys.stderr.flush()
+
+
 class TCPClientHandler:
     """Обработчик TCP подключений (полностью из оригинального client.py)"""
 
@@ -34,10 +62,10 @@ class TCPClientHandler:
         try:
             print(f"TCP подключение к {server_host}:{server_port}...")
 
-            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.socket.settimeout(CONNECTION_TIMEOUT)
-            self.socket.connect((server_host, server_port))
-            self.socket.settimeout(SOCKET_TIMEOUT)
+            self.socket = create_socket()
+            connect_socket(
+                self.socket, (server_host, server_port), CONNECTION_TIMEOUT
+            )
 
             send_all(self.socket, f"CLIENT {client_id}\n")
             response = recv_until(self.socket)
@@ -45,6 +73,10 @@ class TCPClientHandler:
             if response == "OK":
                 self.connected = True
                 print(f"✓ Подключено к TCP серверу {server_host}:{server_port}")
+                # Ядро может урезать запрошенные буферы (wmem_max/rmem_max)
+                sndbuf = self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)
+                rcvbuf = self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+                print(f"Буферы сокета: отправка {sndbuf // 1024} КБ, прием {rcvbuf // 1024} КБ")
                 return True
             else:
                 print(f"✗ Ошибка: {response}")
@@ -121,23 +153,30 @@ class TCPClientHandler:
         print(f"\nTCP загрузка файла '{basename}' ({filesize} байт)...")
 
         cmd = f"UPLOAD {basename} {filesize}\n"
-        send_all(self.socket, cmd)
 
         stats = FileTransferStats()
         stats.start()
 
         try:
-            with open(filename, "rb") as f:
+            # Команда и данные файла уходят одним потоком полных сегментов
+            with cork(self.socket), open(filename, "rb") as f:
+                send_all(self.socket, cmd)
                 sent = 0
+                last_print = 0.0
                 while sent < filesize:
-                    data = f.read(BUFFER_SIZE)
-                    if not data:
+                    # Файл уходит в сокет через sendfile, минуя Python;
+                    # порции крупные только ради обновления прогресса
+                    count = min(SENDFILE_CHUNK, filesize - sent)
+                    n = send_file(self.socket, f, sent, count)
+                    if not n:
                         break
-                    send_all(self.socket, data)
-                    sent += len(data)
-                    stats.add_bytes(len(data))
-                    percent = (sent / filesize) * 100
-                    print(f"\rЗагрузка: {percent:.1f}%", end="")
+                    sent += n
+                    stats.add_bytes(n)
+
+                    now = time.monotonic()
+                    if now - last_print >= PROGRESS_UPDATE_INTERVAL or sent >= filesize:
+                        _print_progress(f"Загрузка: {sent / filesize * 100:.1f}%")
+                        last_print = now
 
             print()
             stats.stop()
@@ -185,22 +224,35 @@ class TCPClientHandler:
 
         try:
             mode = "ab" if offset > 0 else "wb"
-            with open(basename, mode) as f:
+            # Крупный буфер записи: блоки из сокета копятся и уходят на диск
+            # одним write на FILE_WRITE_BUFFER байт
+            with open(basename, mode, buffering=FILE_WRITE_BUFFER) as f:
                 if mode == "ab":
                     f.seek(offset)
 
                 received = offset
-                buffer_size = BUFFER_SIZE * 4
+                buffer_size = TCP_CHUNK_SIZE
+
+                # Один буфер на всю передачу: данные из сокета пишутся прямо
+                # в него, а из него - в файл
+                buffer = memoryview(bytearray(buffer_size))
+                last_print = 0.0
 
                 while received < filesize:
                     chunk_size = min(buffer_size, filesize - received)
-                    data = recv_exact(self.socket, chunk_size)
+                    data = buffer[:chunk_size]
+                    recv_exact_into(self.socket, data)
                     f.write(data)
-                    received += len(data)
-                    stats.add_bytes(len(data))
+                    received += chunk_size
+                    stats.add_bytes(chunk_size)
+
+                    now = time.monotonic()
+                    if now - last_print >= PROGRESS_UPDATE_INTERVAL or received >= filesize:
+                        _print_progress(f"Скачивание: {received / filesize * 100:.1f}%")
+                        last_print = now
 
-                    percent = (received / filesize) * 100
-                    print(f"\rСкачивание: {percent:.1f}%", end="")
+                # Остаток буфера - на диск до подсчета статистики
+                f.flush()
 
             print()
             stats.stop()
@@ -220,8 +272,15 @@ class UDPClientHandler:
         self.server_addr = None
         self.client_id = None
         self.stats = FileTransferStats()
+        # Окно и таймаут повтора подстраиваются по ACK (AIMD и RTT)
         self.window_size = 64
+        self.min_window_size = 16
+        self.max_window_size = SACK_BITMAP_BITS
         self.packet_timeout = 0.1
+        self.min_packet_timeout = 0.01
+        self.max_packet_timeout = 1.0
+        # Общий буфер приема датаграмм вместо нового bytes на каждый recvfrom
+        self.recv_buffer = bytearray(MAX_DATAGRAM)
 
     def connect(self, server_host, server_port, client_id):
         """Подключение к UDP серверу"""
@@ -240,8 +299,7 @@ class UDPClientHandler:
 
             for attempt in range(3):
                 try:
-                    data, addr = self.socket.recvfrom(65535)
-                    result = parse_packet(data)
+                    result = self._recv_packet()
                     if result and result[2] & FLAG_ACK and result[3] == b"OK":
                         self.connected = True
                         print(f"✓ Подключено к UDP серверу {server_host}:{server_port}")
@@ -358,7 +416,9 @@ class UDPClientHandler:
                 print("✗ Сервер не готов к приему файла")
                 return
 
-            self._send_file_fast(filename, filesize)
+            response = self._send_file_fast(filename, filesize)
+            if response:
+                print(f"Сервер: {response}")
 
         except Exception as e:
             print(f"\n✗ Ошибка при UDP загрузке: {e}")
@@ -396,112 +456,256 @@ class UDPClientHandler:
             print(f"\n✗ Ошибка при UDP скачивании: {e}")
 
     def _send_file_fast(self, filename, filesize):
-        """Быстрая отправка файла"""
+        """Быстрая отправка файла, возвращает итоговый ответ сервера"""
         self.stats.start()
 
         data_size = 1400 - PACKET_HEADER_SIZE
         total_packets = (filesize + data_size - 1) // data_size
 
-        window = {}
-        next_seq = 1000
-        base_seq = 1000
+        # Окно - кольцо слотов (слот = seq % емкость): параллельные массивы
+        # вместо словаря словарей на каждый пакет. Емкость - максимум окна,
+        # а в полете одновременно не больше self.window_size пакетов
+        size = self.max_window_size
+        slot_packets = [None] * size  # None - слот свободен
+        slot_seqs = array("q", bytes(8 * size))
+        slot_times = array("d", bytes(8 * size))
+        slot_resends = array("B", bytes(size))
+        in_flight = 0
+        deadlines = []  # Куча (срок повтора, seq) для пакетов в полете
+
+        # Сглаженное RTT и его разброс (алгоритм Джекобсона)
+        srtt = None
+        rttvar = 0.0
+        response = None
+
+        next_seq = DATA_FIRST_SEQ
+        base_seq = DATA_FIRST_SEQ
+        sack_base = DATA_FIRST_SEQ  # Все пакеты до него подтверждены SACK
         sent_bytes = 0
-        last_update = time.time()
-
-        with open(filename, "rb") as f:
-            print("Отправка данных...")
-
-            while base_seq < next_seq or sent_bytes < filesize:
-                while len(window) < self.window_size and sent_bytes < filesize:
-                    chunk = f.read(data_size)
-                    if not chunk:
-                        break
-
-                    flags = FLAG_DATA
-                    sent_bytes += len(chunk)
-                    if sent_bytes >= filesize:
-                        flags |= FLAG_END
-
-                    packet = create_packet(next_seq, total_packets, flags, chunk)
-                    window[next_seq] = {
-                        "packet": packet,
-                        "time": time.time(),
-                        "resends": 0,
-                    }
+        # Время - монотонное (RTT не зависит от перевода часов) и читается
+        # пару раз за итерацию, а не на каждый пакет
+        start = last_update = time.monotonic()
+
+        # Неблокирующий режим: ACK выбираются без ожидания таймаута сокета,
+        # ждем (select) только когда окно заполнено. Отдельный поток приема
+        # ACK не нужен: основной цикл на recv не блокируется, а второй поток
+        # только делил бы с ним GIL
+        prev_timeout = self.socket.gettimeout()
+        self.socket.setblocking(False)
+
+        mm = view = None
+        try:
+            with open(filename, "rb") as f:
+                if filesize:
+                    # Данные пакетов берутся срезами отображения файла в память,
+                    # без f.read и нового bytes на каждый пакет
+                    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    view = memoryview(mm)
+
+                print("Отправка данных...")
+
+                while in_flight or sent_bytes < filesize:
+                    now = time.monotonic()
+                    batch = []
+                    while in_flight < self.window_size and sent_bytes < filesize:
+                        idx = next_seq % size
+                        if slot_packets[idx] is not None:
+                            break  # Слот занят старым неподтвержденным пакетом
+
+                        offset = sent_bytes
+                        sent_bytes = min(offset + data_size, filesize)
+
+                        flags = FLAG_DATA
+                        if sent_bytes >= filesize:
+                            flags |= FLAG_END
+
+                        # Срез не сохраняется, иначе mm.close() не пройдет
+                        packet = create_packet(
+                            next_seq, total_packets, flags, view[offset:sent_bytes]
+                        )
+                        slot_packets[idx] = packet
+                        slot_seqs[idx] = next_seq
+                        slot_times[idx] = now
+                        slot_resends[idx] = 0
+                        in_flight += 1
+                        heapq.heappush(
+                            deadlines, (slot_times[idx] + self.packet_timeout, next_seq)
+                        )
+
+                        batch.append(packet)
+                        self.stats.add_bytes(len(packet))
+                        next_seq += 1
+
+                    if batch:
+                        # Новые пакеты окна уходят пачкой, а не sendto на каждый
+                        try:
+                            send_packets(self.socket, batch, self.server_addr)
+                        except OSError as e:
+                            if e.errno not in SEND_RETRY_ERRNOS:
+                                raise
+                            # Буфер отправки полон: ждем места, а неотправленные
+                            # пакеты уйдут повтором по своим срокам
+                            select.select([], [self.socket], [], self.packet_timeout)
+                    else:
+                        # Ждем ACK не дольше ближайшего события: срока повтора
+                        # или обновления прогресса
+                        next_event = last_update + 0.2
+                        if deadlines:
+                            next_event = min(next_event, deadlines[0][0])
+                        select.select([self.socket], [], [], max(next_event - now, 0))
 
-                    self.socket.sendto(packet, self.server_addr)
-                    self.stats.add_bytes(len(packet))
-                    next_seq += 1
+                    now = time.monotonic()
 
-                try:
                     while True:
-                        data, addr = self.socket.recvfrom(65535)
-                        result = parse_packet(data)
-                        if result and result[2] & FLAG_ACK:
-                            ack_id = result[0]
-                            if ack_id in window:
-                                del window[ack_id]
-                                if ack_id >= base_seq:
-                                    base_seq = ack_id + 1
-                except socket.timeout:
-                    pass
-
-                current_time = time.time()
-                for seq, info in list(window.items()):
-                    if current_time - info["time"] > self.packet_timeout:
-                        if info["resends"] < 3:
-                            self.socket.sendto(info["packet"], self.server_addr)
-                            info["time"] = current_time
-                            info["resends"] += 1
-                            self.stats.add_bytes(len(info["packet"]))
-
-                if current_time - last_update > 0.2:
-                    percent = (sent_bytes / filesize) * 100
-                    speed = (
-                        self.stats.total_bytes
-                        * 8
-                        / (current_time - self.stats.start_time)
-                        / 1000
-                    )
-                    print(
-                        f"\rЗагрузка: {percent:.1f}% | {self._format_bytes(sent_bytes)}/{self._format_bytes(filesize)} | {speed:.0f} Кбит/с",
-                        end="",
-                    )
-                    last_update = current_time
+                        try:
+                            result = self._recv_packet()
+                        except BlockingIOError:
+                            break
+                        if not result:
+                            continue
+                        if not result[2] & FLAG_ACK:
+                            # Итоговый ответ сервера может прийти раньше
+                            # последнего ACK - сохраняем его
+                            if result[2] & FLAG_DATA:
+                                response = bytes(result[3])
+                            continue
 
-                time.sleep(0.001)
+                        if result[2] & FLAG_SACK_BITMAP:
+                            # SACK: все пакеты до его границы и отмеченные битами
+                            ack_ids = list(range(sack_base, result[0]))
+                            sack_base = max(sack_base, result[0])
+                            ack_ids += parse_sack_bitmap(result[0], result[3])
+                        else:
+                            ack_ids = (result[0],)
+
+                        for ack_id in ack_ids:
+                            idx = ack_id % size
+                            if slot_packets[idx] is None or slot_seqs[idx] != ack_id:
+                                continue
+
+                            # RTT меряем только по пакетам без повторов (Карн)
+                            if not slot_resends[idx]:
+                                sample = now - slot_times[idx]
+                                if srtt is None:
+                                    srtt = sample
+                                    rttvar = sample / 2
+                                else:
+                                    rttvar = 0.75 * rttvar + 0.25 * abs(srtt - sample)
+                                    srtt = 0.875 * srtt + 0.125 * sample
+                                self.packet_timeout = min(
+                                    max(srtt + 4 * rttvar, self.min_packet_timeout),
+                                    self.max_packet_timeout,
+                                )
+
+                            slot_packets[idx] = None
+                            in_flight -= 1
+                            if self.window_size < self.max_window_size:
+                                self.window_size += 1
+                            if ack_id >= base_seq:
+                                base_seq = ack_id + 1
+
+                    # Проверяются только пакеты с истекшим сроком - вершина кучи.
+                    # Записи подтвержденных пакетов просто пропускаются
+                    resend_batch = []
+                    while deadlines and deadlines[0][0] <= now:
+                        seq = heapq.heappop(deadlines)[1]
+                        idx = seq % size
+                        packet = slot_packets[idx]
+                        if packet is None or slot_seqs[idx] != seq:
+                            continue
+                        if slot_resends[idx] < 3:
+                            resend_batch.append(packet)
+                            slot_times[idx] = now
+                            slot_resends[idx] += 1
+                            self.stats.add_bytes(len(packet))
+                            heapq.heappush(
+                                deadlines, (now + self.packet_timeout, seq)
+                            )
+                        else:
+                            # Попытки исчерпаны - освобождаем слот, иначе
+                            # кольцо остановится на этом пакете
+                            slot_packets[idx] = None
+                            in_flight -= 1
+
+                    # Потери - признак перегрузки: окно уменьшается вдвое.
+                    # Повторы уходят одной пачкой, как и новые пакеты
+                    if resend_batch:
+                        try:
+                            send_packets(self.socket, resend_batch, self.server_addr)
+                        except OSError as e:
+                            # Буфер отправки полон - пакеты уйдут на следующем сроке
+                            if e.errno not in SEND_RETRY_ERRNOS:
+                                raise
+                        self.window_size = max(
+                            self.window_size // 2, self.min_window_size
+                        )
+
+                    if now - last_update > 0.2:
+                        percent = (sent_bytes / filesize) * 100
+                        speed = self.stats.total_bytes * 8 / (now - start) / 1000
+                        _print_progress(
+                            f"Загрузка: {percent:.1f}% | {self._format_bytes(sent_bytes)}/{self._format_bytes(filesize)} | {speed:.0f} Кбит/с"
+                        )
+                        last_update = now
+        finally:
+            if view is not None:
+                view.release()
+            if mm is not None:
+                mm.close()
+            self.socket.settimeout(prev_timeout)
 
         print()
         self.stats.stop()
         self._print_stats("UDP загрузка файла")
 
+        if response is None:
+            return self._wait_for_response(timeout=3)
+        return response.decode("utf-8", errors="ignore")
+
     def _receive_file_fast(self, filepath, filesize):
         """Быстрый прием файла"""
         self.stats.start()
 
-        # Предварительно выделяем память
-        packets = [None] * ((filesize // 1300) + 1000)
+        # Пакеты пишутся в файл сразу по своему смещению, в памяти
+        # хранятся только флаги полученных пакетов
+        data_size = 1400 - PACKET_HEADER_SIZE
+        total_packets = (filesize + data_size - 1) // data_size
+        got_packets = bytearray(total_packets)
         received = 0
-        expected_packets = set()
 
         # Увеличиваем буферы до максимума
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 8 * 1024 * 1024)
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 8 * 1024 * 1024)
-        self.socket.settimeout(0.001)  # Минимальный таймаут
+        # Неблокирующий режим: очередь датаграмм выбирается без poll перед
+        # каждым recv, ожидание (select) - только когда очередь пуста
+        prev_timeout = self.socket.gettimeout()
+        self.socket.setblocking(False)
 
         print("Прием данных на максимальной скорости...")
 
-        last_progress = time.time()
-        last_ack = time.time()
-        ack_batch = []
+        # Сервер шлет файл без окна и повторов, поэтому пакеты
+        # не подтверждаются: ACK некому было бы разбирать
+        start = last_progress = time.monotonic()
 
-        while received < filesize:
-            try:
-                # Принимаем все доступные пакеты
-                while True:
-                    try:
-                        data, addr = self.socket.recvfrom(65535)
-                        result = parse_packet(data)
+        # Ошибки записи (нет места, ввод-вывод) не глушатся: иначе цикл
+        # ждал бы недостающие байты вечно. Таймаут сокета восстанавливается
+        # при любом выходе
+        try:
+            with open(filepath, "wb") as f:
+                preallocate_file(f, filesize)
+
+                while received < filesize:
+                    select.select([self.socket], [], [], 0.001)
+
+                    # Принимаем все доступные пакеты
+                    while True:
+                        try:
+                            result = self._recv_packet()
+                        except BlockingIOError:
+                            break
+                        except OSError:
+                            # Ошибка ICMP от прошлой отправки - читаем дальше
+                            continue
                         if not result:
                             continue
 
@@ -511,61 +715,34 @@ class UDPClientHandler:
                             continue
 
                         # Сохраняем пакет
-                        if packets[packet_id - 1000] is None:
-                            packets[packet_id - 1000] = payload
+                        index = packet_id - 1000
+                        if 0 <= index < total_packets and not got_packets[index]:
+                            got_packets[index] = 1
+                            write_at(f, payload, index * data_size)
                             received += len(payload)
                             self.stats.add_bytes(len(payload) + PACKET_HEADER_SIZE)
-                            ack_batch.append(packet_id)
-
-                    except socket.timeout:
-                        break
-
-                # Отправляем ACK пачкой
-                current_time = time.time()
-                if ack_batch and (
-                    current_time - last_ack > 0.005 or len(ack_batch) > 50
-                ):
-                    for ack_id in ack_batch[:20]:  # Не больше 20 за раз
-                        ack = create_ack_packet(ack_id)
-                        self.socket.sendto(ack, self.server_addr)
-                    ack_batch = ack_batch[20:]
-                    last_ack = current_time
-
-                # Прогресс
-                if current_time - last_progress > 0.1:
-                    percent = (received / filesize) * 100
-                    speed = (
-                        self.stats.total_bytes
-                        * 8
-                        / (current_time - self.stats.start_time)
-                        / 1000
-                    )
-                    print(
-                        f"\rСкачивание: {percent:.1f}% | {self._format_bytes(received)}/{self._format_bytes(filesize)} | {speed:.0f} Кбит/с",
-                        end="",
-                    )
-                    last_progress = current_time
-
-            except Exception as e:
-                continue
 
+                    # Прогресс
+                    current_time = time.monotonic()
+                    if current_time - last_progress > PROGRESS_UPDATE_INTERVAL:
+                        percent = (received / filesize) * 100
+                        speed = (
+                            self.stats.total_bytes * 8 / (current_time - start) / 1000
+                        )
+                        _print_progress(
+                            f"Скачивание: {percent:.1f}% | {self._format_bytes(received)}/{self._format_bytes(filesize)} | {speed:.0f} Кбит/с"
+                        )
+                        last_progress = current_time
+        finally:
+            self.socket.settimeout(prev_timeout)
         print()
 
-        # Сохраняем файл
-        if any(packets):
-            # Убираем None из конца
-            valid_packets = [p for p in packets if p is not None]
-
-            with open(filepath, "wb") as f:
-                for packet in valid_packets:
-                    f.write(packet)
-
-            saved_size = os.path.getsize(filepath)
-            if saved_size == filesize:
-                print(f"✓ Файл сохранен: {os.path.basename(filepath)}")
-            else:
-                print(f"⚠ Размер не совпадает: {saved_size} != {filesize}")
+        if received == filesize:
+            print(f"✓ Файл сохранен: {os.path.basename(filepath)}")
+        elif received:
+            print(f"⚠ Размер не совпадает: {received} != {filesize}")
         else:
+            os.remove(filepath)
             print("✗ Не получено данных")
 
         self.stats.stop()
@@ -577,30 +754,34 @@ class UDPClientHandler:
             ratio = self.stats.get_bitrate() / tcp_equiv
             print(f"✓ UDP быстрее TCP в {ratio:.2f} раз")
 
+    def _recv_packet(self):
+        """
+        Прием датаграммы в общий буфер и ее разбор
+        Данные пакета - срез буфера, до следующего приема их нужно скопировать
+        """
+        return recv_packet(self.socket, self.recv_buffer)[0]
+
     def _wait_for_response(self, timeout=3):
         """Ожидание ответа от сервера"""
-        start_time = time.time()
-        data = b""
+        deadline = time.monotonic() + timeout
         packets = {}
 
-        while time.time() - start_time < timeout:
+        while time.monotonic() < deadline:
             try:
-                packet, addr = self.socket.recvfrom(65535)
-                result = parse_packet(packet)
+                result = self._recv_packet()
                 if not result:
                     continue
 
                 packet_id, total, flags, payload = result
 
                 if flags & FLAG_DATA:
-                    packets[packet_id] = payload
+                    packets[packet_id] = bytes(payload)
                     ack = create_ack_packet(packet_id)
                     self.socket.sendto(ack, self.server_addr)
 
                 if flags & FLAG_END:
-                    for i in range(total):
-                        if i in packets:
-                            data += packets[i]
+                    # Одна склейка вместо копирования при каждом +=
+                    data = b"".join(packets[i] for i in range(total) if i in packets)
                     return data.decode("utf-8", errors="ignore")
 
             except socket.timeout:
@@ -644,11 +825,7 @@ class UDPClientHandler:
 
     def _format_bytes(self, bytes_count):
         """Форматирование размера"""
-        for unit in ["Б", "КБ", "МБ", "ГБ"]:
-            if bytes_count < 1024.0:
-                return f"{bytes_count:.1f} {unit}"
-            bytes_count /= 1024.0
-        return f"{bytes_count:.1f} ТБ"
+        return format_bytes(bytes_count)
 
 
 class Client:
@@ -2,6 +2,7 @@
 Модуль для работы с файлами, поддержка докачки и подсчет битрейта
 """
 import os
+import re
 import time
 import shutil
 from app_config import UPLOADS_DIR, PARTIAL_DIR, BUFFER_SIZE
@@ -41,11 +42,25 @@ class FileTransferStats:
         print(f"Время: {duration:.2f} сек")
 
     def _format_bytes(self, bytes_count):
-        for unit in ['Б', 'КБ', 'МБ', 'ГБ']:
-            if bytes_count < 1024.0:
-                return f"{bytes_count:.1f} {unit}"
-            bytes_count /= 1024.0
-        return f"{bytes_count:.1f} ТБ"
+        return format_bytes(bytes_count)
+
+
+_BYTE_UNITS = ('Б', 'КБ', 'МБ', 'ГБ', 'ТБ')
+
+
+def format_bytes(bytes_count):
+    """Форматирование размера: единица по числу бит, без цикла делений"""
+    index = min(max(int(bytes_count).bit_length() - 1, 0) // 10, len(_BYTE_UNITS) - 1)
+    return f"{bytes_count / (1 << (10 * index)):.1f} {_BYTE_UNITS[index]}"
+
+
+# Всё, кроме букв, цифр и "._-" (как str.isalnum), вырезается из имен
+_UNSAFE_CHARS = re.compile(r"[^\w.-]")
+
+
+def _safe_name(name):
+    """Очистка имени для использования в пути к временному файлу"""
+    return _UNSAFE_CHARS.sub("", name)
 
 
 def ensure_dirs():
@@ -62,10 +77,70 @@ def get_file_size(filepath):
         return 0
 
 
+# Максимальное число буферов в одном вызове writev
+IOV_MAX = 1024
+
+
+def write_chunks(filepath, chunks, exclusive=False):
+    """
+    Запись списка буферов в файл одним writev на каждые IOV_MAX буферов
+    При exclusive=True существующий файл не перезаписывается (FileExistsError)
+    """
+    if not hasattr(os, "writev"):
+        with open(filepath, "xb" if exclusive else "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+        return
+
+    flags = os.O_WRONLY | os.O_CREAT | (os.O_EXCL if exclusive else os.O_TRUNC)
+    fd = os.open(filepath, flags, 0o644)
+    try:
+        for i in range(0, len(chunks), IOV_MAX):
+            batch = chunks[i : i + IOV_MAX]
+            written = os.writev(fd, batch)
+
+            # writev может записать меньше, чем передано - дописываем остаток
+            for chunk in batch:
+                if written >= len(chunk):
+                    written -= len(chunk)
+                    continue
+                view = memoryview(chunk)[written:]
+                while view:
+                    view = view[os.write(fd, view) :]
+                written = 0
+    finally:
+        os.close(fd)
+
+
+def preallocate_file(f, size):
+    """Резервирование места под файл заранее (без дыр и фрагментации)"""
+    if hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(f.fileno(), 0, size)
+            return
+        except OSError:
+            pass  # ФС не поддерживает fallocate
+    f.truncate(size)
+
+
+def write_at(f, data, offset):
+    """Запись данных по смещению без перемещения позиции файла"""
+    if hasattr(os, "pwrite"):
+        view = memoryview(data)
+        while view:
+            written = os.pwrite(f.fileno(), view, offset)
+            view = view[written:]
+            offset += written
+        return
+
+    f.seek(offset)
+    f.write(data)
+
+
 def save_partial_file(client_id, filename, data, offset):
     """Сохранение части файла для докачки"""
-    safe_client = "".join(c for c in client_id if c.isalnum() or c in '._-')
-    safe_filename = "".join(c for c in filename if c.isalnum() or c in '._-')
+    safe_client = _safe_name(client_id)
+    safe_filename = _safe_name(filename)
 
     partial_path = os.path.join(PARTIAL_DIR, f"{safe_client}_{safe_filename}.part")
 
@@ -78,8 +153,8 @@ def save_partial_file(client_id, filename, data, offset):
 
 def finalize_file(client_id, filename):
     """Завершение файла - перенос из временной папки"""
-    safe_client = "".join(c for c in client_id if c.isalnum() or c in '._-')
-    safe_filename = "".join(c for c in filename if c.isalnum() or c in '._-')
+    safe_client = _safe_name(client_id)
+    safe_filename = _safe_name(filename)
 
     partial_path = os.path.join(PARTIAL_DIR, f"{safe_client}_{safe_filename}.part")
     final_path = os.path.join(UPLOADS_DIR, filename)
@@ -101,8 +176,8 @@ def finalize_file(client_id, filename):
 
 def get_partial_size(client_id, filename):
     """Получение размера частично загруженного файла"""
-    safe_client = "".join(c for c in client_id if c.isalnum() or c in '._-')
-    safe_filename = "".join(c for c in filename if c.isalnum() or c in '._-')
+    safe_client = _safe_name(client_id)
+    safe_filename = _safe_name(filename)
 
     partial_path = os.path.join(PARTIAL_DIR, f"{safe_client}_{safe_filename}.part")
 
@@ -113,11 +188,11 @@ def get_partial_size(client_id, filename):
 
 def cleanup_partial(client_id, filename=None):
     """Очистка временных файлов"""
-    safe_client = "".join(c for c in client_id if c.isalnum() or c in '._-')
+    safe_client = _safe_name(client_id)
 
     try:
         if filename:
-            safe_filename = "".join(c for c in filename if c.isalnum() or c in '._-')
+            safe_filename = _safe_name(filename)
             partial_path = os.path.join(PARTIAL_DIR, f"{safe_client}_{safe_filename}.part")
             if os.path.exists(partial_path):
                 os.remove(partial_path)
@@ -6,30 +6,66 @@ import socket
 import time
 import threading
 import os
+import mmap
 import shutil
 import select
 from datetime import datetime
 
 from app_config import *
-from socket_handler import recv_until, recv_exact, send_all
+from socket_handler import (
+    recv_exact,
+    send_all,
+    send_all_vec,
+    send_bytes,
+    set_cork,
+    set_fastopen,
+    set_low_latency,
+    set_socket_buffers,
+)
 from file_handler import (
     ensure_dirs,
     get_file_size,
+    write_chunks,
     FileTransferStats,
 )
 from udp_handler import *
 from sliding_window import ReceiveWindow
 
+# os.sendfile есть не на всех платформах (например, нет на Windows)
+HAS_SENDFILE = hasattr(os, "sendfile")
+
+# Неизменяемые ответы TCP команд кодируются один раз при загрузке модуля
+CLIENT_OK_RESPONSE = "OK\n".encode("utf-8")
+CLOSE_RESPONSE = "Соединение закрывается\n".encode("utf-8")
+UNKNOWN_RESPONSE = "Неизвестная команда\n".encode("utf-8")
+TIME_PREFIX = "Текущее время сервера: ".encode("utf-8")
+
+# Порог обработанных байт, после которого буфер команд сжимается
+BUFFER_COMPACT_THRESHOLD = 4096
+
+# Границы адаптивного размера чтения из TCP сокета клиента (байт)
+RECV_SIZE_MIN = 4096
+RECV_SIZE_MAX = 256 * 1024
+
+# Сколько UDP датаграмм читается подряд после одного select. Очередь
+# сокета вычитывается без лишних select, а предел не дает потоку UDP
+# надолго отнять цикл у TCP клиентов
+UDP_DRAIN_LIMIT = 32
+
 
 class ClientState:
     """Класс для хранения состояния TCP клиента отдельно от сокета"""
 
     def __init__(self, addr):
         self.addr = addr
-        self.buffer = b""
+        self.buffer = bytearray()
+        self.buf_pos = 0  # Начало необработанных данных в buffer
+        self.recv_size = BUFFER_SIZE  # Размер следующего чтения из сокета
         self.client_id = None  # Логическое имя клиента
         self.upload_state = None
         self.download_state = None
+        # DOWNLOAD, ждущий от клиента строку со смещением: (имя, путь, размер)
+        self.pending_download = None
 
     @property
     def display_id(self):
@@ -44,6 +80,14 @@ class TCPServerHandler:
 
     def __init__(self, server):
         self.server = server
+        self._tcp_cmds = {
+            "CLIENT": self._cmd_client,
+            "CLOSE": self._cmd_close,
+            "TIME": self._cmd_time,
+            "ECHO": self._cmd_echo,
+            "UPLOAD": self._cmd_upload,
+            "DOWNLOAD": self._cmd_download,
+        }
 
     def process_command(self, client_sock, state, command):
         """Обработка одной TCP команды"""
@@ -51,52 +95,13 @@ class TCPServerHandler:
         try:
             print(f"Команда от {state.display_id}: {command}")
 
-            # --- HANDSHAKE (Регистрация клиента) ---
-            if command.startswith("CLIENT "):
-                requested_id = command.split(" ", 1)[1].strip()
-
-                # Проверка на уникальность ID
-                if requested_id in self.server.connected_ids:
-                    print(f"Попытка входа с дублирующимся ID: {requested_id}")
-                    send_all(client_sock, "ERROR: ID already taken\n")
-                    return True  # Закрываем соединение
-
-                # Регистрация успешна
-                self.server.connected_ids.add(requested_id)
-                state.client_id = requested_id
-                print(f"Клиент зарегистрирован: {requested_id}")
-                send_all(client_sock, "OK\n")
-                return False
-
-            elif command == "CLOSE":
-                send_all(client_sock, "Соединение закрывается\n")
-                return True  # сигнал на закрытие
-
-            elif command == "TIME":
-                response = (
-                    f"Текущее время сервера: {datetime.now().strftime('%H:%M:%S')}\n"
-                )
-                send_all(client_sock, response)
-
-            elif command.startswith("ECHO"):
-                response = command[5:] + "\n" if len(command) > 5 else "\n"
-                send_all(client_sock, response)
-
-            elif command.startswith("UPLOAD "):
-                parts = command.split()
-                if len(parts) == 3:
-                    filename = parts[1]
-                    filesize = int(parts[2])
-                    self._handle_upload_nonblocking(state, filename, filesize)
-                else:
-                    send_all(client_sock, "ERROR: Неверный формат UPLOAD\n")
+            # Диспетчеризация по первому слову команды
+            verb, _, rest = command.partition(" ")
+            handler = self._tcp_cmds.get(verb)
+            if handler:
+                return handler(client_sock, state, rest)
 
-            elif command.startswith("DOWNLOAD "):
-                filename = command[9:]
-                self._handle_download_nonblocking(client_sock, state, filename)
-
-            else:
-                send_all(client_sock, "Неизвестная команда\n")
+            send_bytes(client_sock, UNKNOWN_RESPONSE)
 
         except Exception as e:
             print(f"Error processing command: {e}")
@@ -107,32 +112,98 @@ class TCPServerHandler:
 
         return False
 
+    def _cmd_client(self, client_sock, state, rest):
+        """HANDSHAKE (Регистрация клиента)"""
+        requested_id = rest.strip()
+        if not requested_id:
+            send_all(client_sock, "ERROR: Empty client ID\n")
+            return False
+
+        # Проверка на уникальность ID
+        if requested_id in self.server.connected_ids:
+            print(f"Попытка входа с дублирующимся ID: {requested_id}")
+            send_all(client_sock, "ERROR: ID already taken\n")
+            return True  # Закрываем соединение
+
+        # Регистрация успешна
+        self.server.connected_ids.add(requested_id)
+        state.client_id = requested_id
+        print(f"Клиент зарегистрирован: {requested_id}")
+        send_bytes(client_sock, CLIENT_OK_RESPONSE)
+        return False
+
+    def _cmd_close(self, client_sock, state, rest):
+        # CLOSE и TIME принимаются только без аргументов
+        if rest:
+            send_bytes(client_sock, UNKNOWN_RESPONSE)
+            return False
+        send_bytes(client_sock, CLOSE_RESPONSE)
+        return True  # сигнал на закрытие
+
+    def _cmd_time(self, client_sock, state, rest):
+        if rest:
+            send_bytes(client_sock, UNKNOWN_RESPONSE)
+            return False
+        now = datetime.now().strftime("%H:%M:%S\n").encode("ascii")
+        send_all_vec(client_sock, (TIME_PREFIX, now))
+        return False
+
+    def _cmd_echo(self, client_sock, state, rest):
+        send_all(client_sock, rest + "\n")
+        return False
+
+    def _cmd_upload(self, client_sock, state, rest):
+        parts = rest.split()
+        if len(parts) == 2:
+            filename = parts[0]
+            filesize = int(parts[1])
+            self._handle_upload_nonblocking(state, filename, filesize)
+        else:
+            send_all(client_sock, "ERROR: Неверный формат UPLOAD\n")
+        return False
+
+    def _cmd_download(self, client_sock, state, rest):
+        self._handle_download_nonblocking(client_sock, state, rest)
+        return False
+
     def _handle_download_nonblocking(self, client_sock, state, filename):
         """Инициализация неблокирующего скачивания файла"""
         filename = filename.strip()
         filepath = os.path.join(UPLOADS_DIR, filename)
 
-        if not os.path.exists(filepath):
+        try:
+            filesize = os.stat(filepath).st_size
+        except OSError:
             send_all(client_sock, "ERROR: Файл не найден\n")
             return
 
-        filesize = os.path.getsize(filepath)
         send_all(client_sock, f"FILESIZE {filesize}\n")
 
-        try:
-            # Для простоты в ЛР читаем offset блокирующе (можно улучшить)
-            offset_str = recv_until(client_sock)
-            offset = int(offset_str) if offset_str.isdigit() else 0
-        except Exception:
-            offset = 0
+        # Смещение придет следующей строкой и будет разобрано из state.buffer
+        # в цикле select: отдельное чтение сокета заблокировало бы цикл
+        # и могло забрать байты следующих команд
+        state.pending_download = (filename, filepath, filesize)
+
+    def start_download(self, client_sock, state, offset):
+        """Начало отправки файла, ожидавшего смещение"""
+        filename, filepath, filesize = state.pending_download
+        state.pending_download = None
 
         try:
             f = open(filepath, "rb")
-            if offset > 0:
-                f.seek(offset)
+
+            # Без os.sendfile файл отображается в память целиком, отправка
+            # идет срезами memoryview без промежуточных буферов
+            mm = None
+            if not HAS_SENDFILE and filesize > 0:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+            # Пока идет поток файла, ядро отправляет только полные сегменты
+            set_cork(client_sock, True)
 
             state.download_state = {
                 "file": f,
+                "mm": mm,
                 "filesize": filesize,
                 "offset": offset,
                 "sent": offset,
@@ -148,16 +219,19 @@ class TCPServerHandler:
         filepath = os.path.join(UPLOADS_DIR, filename)
 
         # Если файл существует, добавляем таймстемп
-        if os.path.exists(filepath):
+        try:
+            f = open(filepath, "xb")
+        except FileExistsError:
             base, ext = os.path.splitext(filename)
             filepath = os.path.join(UPLOADS_DIR, f"{base}_{int(time.time())}{ext}")
+            f = open(filepath, "wb")
 
         state.upload_state = {
             "filename": filename,
             "filepath": filepath,
             "filesize": filesize,
             "received": 0,
-            "file": open(filepath, "wb"),
+            "file": f,
         }
         print(f"Начата неблокирующая загрузка {filename} ({filesize} байт)")
 
@@ -168,10 +242,15 @@ class UDPServerHandler:
     def __init__(self, server):
         self.server = server
         self.clients = {}  # addr -> session_data
+        self._udp_cmds = {
+            "TIME": self._cmd_time,
+            "ECHO": self._cmd_echo,
+            "UPLOAD": self._cmd_upload,
+            "DOWNLOAD": self._cmd_download,
+        }
 
-    def handle_packet(self, data, client_addr):
-        """Обработка UDP пакета"""
-        result = parse_packet(data)
+    def handle_packet(self, result, client_addr):
+        """Обработка разобранного UDP пакета"""
         if not result:
             return
 
@@ -180,8 +259,25 @@ class UDPServerHandler:
             f"UDP пакет от {client_addr}: id={packet_id}, flags={flags}, размер={len(payload)}"
         )
 
+        # Подтверждения клиента сами не подтверждаются: файл скачивания
+        # отправляется без окна и повторов
+        if flags & FLAG_ACK:
+            return
+
+        # Данные - срез буфера приема, а сессии хранят их дольше
+        payload = bytes(payload)
+
+        # Данные загружаемого файла подтверждаются SACK в _handle_file_data
+        client_info = self.clients.get(client_addr)
+        is_upload_data = (
+            flags & FLAG_DATA
+            and packet_id != 0
+            and client_info is not None
+            and client_info.get("file_session")
+        )
+
         # Отправляем ACK
-        if not (flags & FLAG_START):
+        if not (flags & FLAG_START) and not is_upload_data:
             ack = create_ack_packet(packet_id)
             self.server.udp_socket.sendto(ack, client_addr)
 
@@ -263,34 +359,10 @@ class UDPServerHandler:
             command = command.strip()
             print(f"UDP команда от {client_info.get('client_id')}: '{command}'")
 
-            if command == "TIME":
-                response = f"Текущее время: {time.strftime('%H:%M:%S')}"
-                self._send_response(client_addr, response)
-
-            elif command.startswith("ECHO"):
-                response = command[5:] if len(command) > 5 else ""
-                self._send_response(client_addr, response)
-
-            elif command.startswith("UPLOAD "):
-                parts = command.split()
-                if len(parts) == 3:
-                    filename = parts[1]
-                    filesize = int(parts[2])
-                    client_info["file_session"] = {
-                        "filename": filename,
-                        "filesize": filesize,
-                        "received": 0,
-                        "packets": {},
-                        "start_time": time.time(),
-                    }
-                    self._send_response(client_addr, "READY")
-                else:
-                    self._send_response(client_addr, "ERROR: Invalid UPLOAD command")
-
-            elif command.startswith("DOWNLOAD "):
-                filename = command[9:].strip()
-                self._handle_download(client_addr, filename)
-
+            verb, _, rest = command.partition(" ")
+            handler = self._udp_cmds.get(verb)
+            if handler:
+                handler(client_addr, client_info, rest)
             else:
                 self._send_response(client_addr, f"Unknown command: {command}")
 
@@ -298,6 +370,37 @@ class UDPServerHandler:
             print(f"Ошибка обработки UDP команды: {e}")
             self._send_response(client_addr, f"ERROR: {e}")
 
+    def _cmd_time(self, client_addr, client_info, rest):
+        if rest:
+            self._send_response(client_addr, f"Unknown command: TIME {rest}")
+            return
+        response = f"Текущее время: {time.strftime('%H:%M:%S')}"
+        self._send_response(client_addr, response)
+
+    def _cmd_echo(self, client_addr, client_info, rest):
+        self._send_response(client_addr, rest)
+
+    def _cmd_upload(self, client_addr, client_info, rest):
+        parts = rest.split()
+        if len(parts) == 2:
+            filename = parts[0]
+            filesize = int(parts[1])
+            client_info["file_session"] = {
+                "filename": filename,
+                "filesize": filesize,
+                "received": 0,
+                "packets": {},
+                "start_time": time.time(),
+                # Учет принятых пакетов для SACK: окно равно ширине маски
+                "ack_window": ReceiveWindow(SACK_BITMAP_BITS, DATA_FIRST_SEQ),
+            }
+            self._send_response(client_addr, "READY")
+        else:
+            self._send_response(client_addr, "ERROR: Invalid UPLOAD command")
+
+    def _cmd_download(self, client_addr, client_info, rest):
+        self._handle_download(client_addr, rest.strip())
+
     def _handle_file_data(
         self, client_addr, client_info, packet_id, total_packets, flags, payload
     ):
@@ -307,15 +410,54 @@ class UDPServerHandler:
             print(f"Нет активной сессии для UDP клиента {client_addr}")
             return
 
+        ack_window = session["ack_window"]
+        if packet_id - ack_window.expected_seq >= ack_window.window_size:
+            # Пакет дальше маски SACK - подтверждаем отдельно
+            ack = create_ack_packet(packet_id)
+            self.server.udp_socket.sendto(ack, client_addr)
+        else:
+            self._record_sack(ack_window, session["packets"], packet_id, total_packets)
+            if ack_window.pending_acks >= SACK_EVERY or flags & FLAG_END:
+                self._send_sack(client_addr, ack_window)
+
         session["packets"][packet_id] = payload
         session["received"] += len(payload)
 
         percent = (session["received"] / session["filesize"]) * 100
         print(f"\rUDP прием {session['filename']}: {percent:.1f}%", end="")
 
-        if flags & FLAG_END:
+        if len(session["packets"]) >= total_packets:
             self._finalize_upload(client_addr, client_info)
 
+    def _record_sack(self, ack_window, packets, packet_id, total_packets):
+        """
+        Учет пакета в маске SACK. Пакеты, принятые за маской с отдельным ACK,
+        отмечаются, когда сдвиг окна доводит маску до них, иначе граница
+        SACK остановилась бы на первом из них
+        """
+        size = ack_window.window_size
+        horizon = ack_window.expected_seq + size
+        ack_window.add_packet(packet_id, total_packets, None)
+        while ack_window.expected_seq + size > horizon:
+            new_horizon = ack_window.expected_seq + size
+            for seq in range(horizon, new_horizon):
+                if seq in packets:
+                    ack_window.add_packet(seq, total_packets, None)
+            horizon = new_horizon
+
+    def _send_sack(self, client_addr, ack_window):
+        """Одно подтверждение всех пакетов, принятых с прошлого SACK"""
+        base_seq, bitmap = ack_window.take_sack()
+        packet = create_sack_bitmap_packet(base_seq, bitmap)
+        self.server.udp_socket.sendto(packet, client_addr)
+
+    def flush_acks(self):
+        """Отправка SACK для загрузок с неподтвержденными пакетами"""
+        for client_addr, client_info in self.clients.items():
+            session = client_info.get("file_session")
+            if session and session["ack_window"].pending_acks:
+                self._send_sack(client_addr, session["ack_window"])
+
     def _finalize_upload(self, client_addr, client_info):
         """Завершение UDP загрузки"""
         session = client_info.get("file_session")
@@ -325,13 +467,15 @@ class UDPServerHandler:
         filename = session["filename"]
         filepath = os.path.join(UPLOADS_DIR, filename)
 
-        if os.path.exists(filepath):
+        packets = session["packets"]
+        chunks = [packets[k] for k in sorted(packets)]
+
+        try:
+            write_chunks(filepath, chunks, exclusive=True)
+        except FileExistsError:
             base, ext = os.path.splitext(filename)
             filepath = os.path.join(UPLOADS_DIR, f"{base}_udp{ext}")
-
-        with open(filepath, "wb") as f:
-            for packet_id in sorted(session["packets"].keys()):
-                f.write(session["packets"][packet_id])
+            write_chunks(filepath, chunks)
 
         duration = time.time() - session["start_time"]
         bitrate = (session["filesize"] * 8) / duration if duration > 0 else 0
@@ -345,11 +489,12 @@ class UDPServerHandler:
         filename = filename.strip()
         filepath = os.path.join(UPLOADS_DIR, filename)
 
-        if not os.path.exists(filepath):
+        try:
+            filesize = os.stat(filepath).st_size
+        except OSError:
             self._send_response(client_addr, "ERROR: Файл не найден")
             return
 
-        filesize = os.path.getsize(filepath)
         print(f"UDP размер файла: {filesize} байт")
         self._send_response(client_addr, f"FILESIZE {filesize}")
 
@@ -359,22 +504,29 @@ class UDPServerHandler:
             with open(filepath, "rb") as f:
                 packet_seq = 1000
                 sent = 0
-                total_packets = (filesize + (1400 - PACKET_HEADER_SIZE) - 1) // (
-                    1400 - PACKET_HEADER_SIZE
-                )
+                data_size = 1400 - PACKET_HEADER_SIZE
+                total_packets = (filesize + data_size - 1) // data_size
+
+                # Один буфер на все пакеты: файл читается сразу за заголовок,
+                # sendto копирует пакет в ядро, и буфер можно заполнять снова
+                buffer = bytearray(PACKET_HEADER_SIZE + data_size)
+                view = memoryview(buffer)
+                payload = view[PACKET_HEADER_SIZE:]
 
                 while True:
-                    chunk = f.read(1400 - PACKET_HEADER_SIZE)
-                    if not chunk:
+                    size = f.readinto(payload)
+                    if not size:
                         break
 
                     flags = FLAG_DATA
-                    sent += len(chunk)
+                    sent += size
                     if sent >= filesize:
                         flags |= FLAG_END
 
-                    packet = create_packet(packet_seq, total_packets, flags, chunk)
-                    self.server.udp_socket.sendto(packet, client_addr)
+                    pack_header_into(buffer, packet_seq, total_packets, flags, size)
+                    self.server.udp_socket.sendto(
+                        view[: PACKET_HEADER_SIZE + size], client_addr
+                    )
                     packet_seq += 1
                     time.sleep(0.002)
 
@@ -421,6 +573,8 @@ class Server:
         self.running = False
         self.tcp_socket = None
         self.udp_socket = None
+        # Сервер однопоточный: одного буфера приема датаграмм достаточно
+        self.udp_buffer = bytearray(MAX_DATAGRAM)
 
         self.connected_ids = set()
 
@@ -436,7 +590,10 @@ class Server:
         # --- TCP ---
         self.tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        # Принятые сокеты наследуют размеры буферов от слушающего
+        set_socket_buffers(self.tcp_socket)
         self.tcp_socket.bind((self.tcp_host, self.tcp_port))
+        set_fastopen(self.tcp_socket)
         self.tcp_socket.listen()
         self.tcp_socket.setblocking(False)
 
@@ -447,6 +604,9 @@ class Server:
 
         print(f"TCP сервер: {self.tcp_host}:{self.tcp_port}")
         print(f"UDP сервер: {self.udp_host}:{self.udp_port}")
+        # Ядро может урезать запрошенные буферы (wmem_max/rmem_max)
+        rcvbuf = self.udp_socket.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+        print(f"Буфер приема UDP: {rcvbuf // 1024} КБ")
 
         inputs = [self.tcp_socket, self.udp_socket]
 
@@ -456,17 +616,22 @@ class Server:
 
         try:
             while self.running:
-                # Select слушает сокеты на чтение
-                readable, _, exceptional = select.select(inputs, [], inputs, 0.1)
+                # Select слушает сокеты на чтение, а сокеты со скачиванием -
+                # и на запись: цикл просыпается, как только в буфере есть место
+                downloads = [s for s, st in tcp_clients.items() if st.download_state]
+                readable, writable, exceptional = select.select(
+                    inputs, downloads, inputs, 0.1
+                )
 
                 # Проталкиваем данные скачивания
-                self.check_downloads(inputs, tcp_clients)
+                self.check_downloads(writable, tcp_clients)
 
                 for sock in readable:
                     # --- новое TCP подключение ---
                     if sock is self.tcp_socket:
                         client_sock, client_addr = self.tcp_socket.accept()
                         client_sock.setblocking(False)
+                        set_low_latency(client_sock)
 
                         # Создаем состояние для этого клиента
                         state = ClientState(client_addr)
@@ -477,11 +642,22 @@ class Server:
 
                     # --- UDP пакет ---
                     elif sock is self.udp_socket:
-                        try:
-                            data, addr = self.udp_socket.recvfrom(65535)
-                            self.udp_handler.handle_packet(data, addr)
-                        except Exception as e:
-                            print(f"UDP Error: {e}")
+                        for _ in range(UDP_DRAIN_LIMIT):
+                            try:
+                                result, addr = recv_packet(
+                                    self.udp_socket, self.udp_buffer
+                                )
+                            except BlockingIOError:
+                                break  # Очередь сокета пуста
+                            except Exception as e:
+                                print(f"UDP Error: {e}")
+                                break
+                            try:
+                                self.udp_handler.handle_packet(result, addr)
+                            except Exception as e:
+                                print(f"UDP Error: {e}")
+                        # Очередь разобрана - подтверждаем остаток пачки
+                        self.udp_handler.flush_acks()
 
                     # --- данные TCP клиента ---
                     else:
@@ -504,7 +680,7 @@ class Server:
 
         try:
             try:
-                data = sock.recv(BUFFER_SIZE)
+                data = sock.recv(state.recv_size)
             except BlockingIOError:
                 return True
 
@@ -512,25 +688,16 @@ class Server:
                 self._close_tcp_client(sock, tcp_clients, inputs)
                 return False
 
+            # Размер чтения подстраивается под поток как окно TCP:
+            # полное чтение - удваиваем, меньше половины - уменьшаем вдвое
+            if len(data) == state.recv_size:
+                state.recv_size = min(state.recv_size * 2, RECV_SIZE_MAX)
+            elif len(data) < state.recv_size // 2:
+                state.recv_size = max(state.recv_size // 2, RECV_SIZE_MIN)
+
             # --- UPLOAD MODE ---
             if state.upload_state:
-                upload = state.upload_state
-                remaining = upload["filesize"] - upload["received"]
-
-                chunk = data[:remaining]
-                upload["file"].write(chunk)
-                upload["received"] += len(chunk)
-
-                extra = data[len(chunk) :]
-                if extra:
-                    state.buffer += extra
-
-                if upload["received"] >= upload["filesize"]:
-                    upload["file"].close()
-                    send_all(sock, f"Файл {upload['filename']} успешно загружен\n")
-                    print(f"\nUPLOAD завершён: {upload['filename']}")
-                    state.upload_state = None
-
+                self._consume_upload(sock, state, data)
                 return True
 
             # --- DOWNLOAD MODE ---
@@ -540,10 +707,36 @@ class Server:
             # --- COMMAND MODE ---
             state.buffer += data
 
-            while b"\n" in state.buffer:
-                line, state.buffer = state.buffer.split(b"\n", 1)
+            while True:
+                if state.upload_state:
+                    # Команда UPLOAD пришла в одном пакете с началом файла
+                    data = bytes(state.buffer[state.buf_pos :])
+                    state.buffer.clear()
+                    state.buf_pos = 0
+                    if data:
+                        self._consume_upload(sock, state, data)
+                    if state.upload_state:
+                        break
+
+                nl = state.buffer.find(b"\n", state.buf_pos)
+                if nl < 0:
+                    break
+                line = bytes(state.buffer[state.buf_pos : nl])
+                state.buf_pos = nl + 1
                 try:
                     command = line.decode("utf-8").strip()
+
+                    # После FILESIZE клиент присылает смещение докачки.
+                    # Если файл уже скачан, он не шлет ничего и сразу
+                    # переходит к следующей команде
+                    if state.pending_download:
+                        if command.isdigit():
+                            self.tcp_handler.start_download(
+                                sock, state, int(command)
+                            )
+                            continue
+                        state.pending_download = None
+
                     if not command:
                         continue
 
@@ -557,6 +750,14 @@ class Server:
                 except UnicodeDecodeError:
                     print("Error decoding command")
 
+            # Сдвигаем буфер только когда обработанная часть стала большой
+            if state.buf_pos == len(state.buffer):
+                state.buffer.clear()
+                state.buf_pos = 0
+            elif state.buf_pos > BUFFER_COMPACT_THRESHOLD:
+                del state.buffer[: state.buf_pos]
+                state.buf_pos = 0
+
             return True
 
         except Exception as e:
@@ -564,27 +765,62 @@ class Server:
             self._close_tcp_client(sock, tcp_clients, inputs)
             return False
 
-    def check_downloads(self, inputs, tcp_clients):
-        """Метод для проталкивания данных скачивания"""
-        for sock in inputs:
+    def _consume_upload(self, sock, state, data):
+        """Запись принятых данных в загружаемый файл"""
+        upload = state.upload_state
+        remaining = upload["filesize"] - upload["received"]
+
+        chunk = data[:remaining]
+        upload["file"].write(chunk)
+        upload["received"] += len(chunk)
+
+        extra = data[len(chunk) :]
+        if extra:
+            state.buffer += extra
+
+        if upload["received"] >= upload["filesize"]:
+            upload["file"].close()
+            send_all(sock, f"Файл {upload['filename']} успешно загружен\n")
+            print(f"\nUPLOAD завершён: {upload['filename']}")
+            state.upload_state = None
+
+    def check_downloads(self, writable, tcp_clients):
+        """Метод для проталкивания данных скачивания в готовые к записи сокеты"""
+        for sock in writable:
             if sock in tcp_clients:
                 state = tcp_clients[sock]
                 if state.download_state:
                     try:
                         dl = state.download_state
-                        remaining = dl["filesize"] - dl["sent"]
-                        if remaining > 0:
-                            chunk_size = min(BUFFER_SIZE, remaining)
-                            data = dl["file"].read(chunk_size)
-                            if data:
-                                try:
-                                    sock.send(data)
-                                    dl["sent"] += len(data)
-                                except BlockingIOError:
-                                    # Откатываем позицию файла, если не удалось отправить
-                                    dl["file"].seek(-len(data), 1)
-                        else:
+                        # Пишем, пока буфер сокета принимает данные: по одному
+                        # блоку за оборот select скорость упиралась бы в таймаут
+                        truncated = False
+                        try:
+                            while dl["sent"] < dl["filesize"]:
+                                remaining = dl["filesize"] - dl["sent"]
+                                if HAS_SENDFILE:
+                                    # Копирование файл -> сокет в ядре
+                                    sent = os.sendfile(
+                                        sock.fileno(),
+                                        dl["file"].fileno(),
+                                        dl["sent"],
+                                        remaining,
+                                    )
+                                else:
+                                    with memoryview(dl["mm"])[dl["sent"] :] as part:
+                                        sent = sock.send(part)
+                                if not sent:
+                                    # Файл стал короче заявленного размера
+                                    truncated = True
+                                    break
+                                dl["sent"] += sent
+                        except BlockingIOError:
+                            pass
+                        if dl["sent"] >= dl["filesize"] or truncated:
+                            if dl["mm"]:
+                                dl["mm"].close()
                             dl["file"].close()
+                            set_cork(sock, False)
                             print(f"DOWNLOAD завершён: {dl['filename']}")
                             state.download_state = None
                     except (BlockingIOError, socket.error):
@@ -610,6 +846,8 @@ class Server:
                     pass
             if state.download_state:
                 try:
+                    if state.download_state["mm"]:
+                        state.download_state["mm"].close()
                     state.download_state["file"].close()
                 except:
                     pass
@@ -1,10 +1,28 @@
 """
 Модуль для реализации скользящего окна в UDP
 """
+import heapq
+import queue
 import time
 import threading
-from collections import OrderedDict
-from udp_handler import create_ack_packet, MAX_RESENDS, ACK_TIMEOUT
+from udp_handler import (
+    create_ack_packet,
+    MAX_RESENDS,
+    ACK_TIMEOUT,
+    SACK_BITMAP_BITS,
+)
+
+
+class _PacketEntry:
+    """Неподтвержденный пакет в окне отправки"""
+
+    __slots__ = ('packet', 'time', 'resends', 'callback')
+
+    def __init__(self, packet, sent_time, callback=None):
+        self.packet = packet
+        self.time = sent_time
+        self.resends = 0
+        self.callback = callback
 
 
 class SlidingWindow:
@@ -17,69 +35,153 @@ class SlidingWindow:
         self.next_seq = 0  # Номер следующего пакета для отправки
         self.packets = {}  # Словарь для хранения неподтвержденных пакетов
         self.timers = {}  # Таймеры для повторной отправки
+        # Куча (срок повтора, seq_num, время отправки) вместо обхода packets
+        self._deadlines = []
+        # Оценка RTT по RFC 6298; timeout пересчитывается по каждому ACK
+        self.srtt = None
+        self.rttvar = None
+        self.min_rto = 0.05
+        self.max_rto = 1.0
+        # Окно перегрузки (AIMD); window_size остается верхней границей
+        self.cwnd = 1.0
+        self.ssthresh = window_size
         self.lock = threading.Lock()
+        # Потоки приема только кладут номера ACK в очередь (put в SimpleQueue
+        # не требует self.lock), а применяет их поток отправителя
+        self._acks = queue.SimpleQueue()
         self.closed = False
 
     def can_send(self):
-        """Проверка, можно ли отправить новый пакет"""
-        with self.lock:
-            return self.next_seq < self.base + self.window_size
+        """
+        Проверка, можно ли отправить новый пакет. Ответ - подсказка:
+        числа читаются без блокировки (под GIL чтение атрибута атомарно),
+        и подтверждения применяются, только если lock свободен
+        """
+        if not self._acks.empty() and self.lock.acquire(blocking=False):
+            try:
+                self._drain_acks()
+            finally:
+                self.lock.release()
+        return self.next_seq < self.base + min(int(self.cwnd), self.window_size)
 
     def add_packet(self, seq_num, packet, callback=None):
         """Добавление пакета в окно"""
+        self.add_packets(((seq_num, packet, callback),))
+
+    def add_packets(self, items):
+        """
+        Добавление пачки пакетов [(seq_num, packet, callback), ...]
+        за один захват блокировки и с одной отметкой времени
+        """
         with self.lock:
-            self.packets[seq_num] = {
-                'packet': packet,
-                'time': time.time(),
-                'resends': 0,
-                'callback': callback
-            }
-            self._start_timer(seq_num)
+            self._drain_acks()
+            # monotonic не скачет при переводе системных часов, иначе
+            # сдвиг времени вызвал бы массовую переотправку
+            now = time.monotonic()
+            deadline = now + self.timeout
+            for seq_num, packet, callback in items:
+                self.packets[seq_num] = _PacketEntry(packet, now, callback)
+                heapq.heappush(self._deadlines, (deadline, seq_num, now))
+                self._start_timer(seq_num)
 
     def ack_received(self, seq_num):
+        """
+        Получено подтверждение. Окно обновится при следующем обращении
+        отправителя (can_send, add_packets, get_resend_packets)
+        """
+        # Время фиксируем сразу, иначе RTT включал бы ожидание в очереди
+        self._acks.put((seq_num, time.monotonic()))
+
+    def _drain_acks(self):
+        """Применение накопленных подтверждений (вызывается под self.lock)"""
+        while True:
+            try:
+                seq_num, ack_time = self._acks.get_nowait()
+            except queue.Empty:
+                return
+            self._apply_ack(seq_num, ack_time)
+
+    def _apply_ack(self, seq_num, ack_time):
         """Обработка полученного подтверждения"""
-        with self.lock:
-            if seq_num in self.packets:
-                # Останавливаем таймер
-                self._stop_timer(seq_num)
+        if seq_num in self.packets:
+            # Останавливаем таймер
+            self._stop_timer(seq_num)
 
-                # Вызываем callback если есть
-                if self.packets[seq_num].get('callback'):
-                    self.packets[seq_num]['callback'](True)
+            # Удаляем пакет
+            info = self.packets.pop(seq_num)
 
-                # Удаляем пакет
-                del self.packets[seq_num]
+            # По правилу Карна RTT меряем только по пакетам без повторов
+            if not info.resends:
+                self._update_rtt(ack_time - info.time)
 
-                # Сдвигаем окно
-                if seq_num >= self.base:
-                    self.base = seq_num + 1
-                    while self.base in self.packets:
-                        self.base += 1
+            # Медленный старт до ssthresh, затем +1 пакет за RTT
+            if self.cwnd < self.ssthresh:
+                self.cwnd += 1
+            elif self.cwnd < self.window_size:
+                self.cwnd += 1 / self.cwnd
 
-                return True
-        return False
+            # Вызываем callback если есть
+            if info.callback:
+                info.callback(True)
+
+            # Сдвигаем окно
+            if seq_num >= self.base:
+                self.base = seq_num + 1
+                while self.base in self.packets:
+                    self.base += 1
+
+    def _update_rtt(self, rtt):
+        """Обновление srtt/rttvar и таймаута повтора"""
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.timeout = min(max(self.srtt + 4 * self.rttvar, self.min_rto), self.max_rto)
 
     def get_resend_packets(self):
         """Получение списка пакетов для повторной отправки"""
+        failed = []
         with self.lock:
+            self._drain_acks()
             resend_list = []
-            current_time = time.time()
-
-            for seq_num, info in list(self.packets.items()):
-                if current_time - info['time'] > self.timeout:
-                    if info['resends'] >= MAX_RESENDS:
-                        # Превышено число попыток
-                        if info.get('callback'):
-                            info['callback'](False)
-                        del self.packets[seq_num]
-                    else:
-                        # Увеличиваем счетчик и добавляем в список на переотправку
-                        info['resends'] += 1
-                        info['time'] = current_time
-                        resend_list.append((seq_num, info['packet']))
-                        self._start_timer(seq_num)
-
-            return resend_list
+            current_time = time.monotonic()
+
+            # Смотрим только истекшие сроки с вершины кучи. Записи уже
+            # подтвержденных пакетов не удаляются при ACK, а пропускаются здесь
+            while self._deadlines and self._deadlines[0][0] <= current_time:
+                deadline, seq_num, sent_time = heapq.heappop(self._deadlines)
+                info = self.packets.get(seq_num)
+                if info is None or info.time != sent_time:
+                    continue
+
+                if info.resends >= MAX_RESENDS:
+                    # Превышено число попыток
+                    del self.packets[seq_num]
+                    if info.callback:
+                        failed.append(info.callback)
+                else:
+                    # Увеличиваем счетчик и добавляем в список на переотправку.
+                    # Таймаут при повторе не удваивается: линейный график
+                    # быстрее восстанавливает хвост передачи
+                    info.resends += 1
+                    info.time = current_time
+                    resend_list.append((seq_num, info.packet))
+                    heapq.heappush(self._deadlines, (current_time + self.timeout, seq_num, current_time))
+                    self._start_timer(seq_num)
+
+            # Потеря: уменьшаем окно один раз на весь вызов, а не на каждый
+            # пакет, иначе пачка таймаутов сбросила бы его несколько раз
+            if resend_list:
+                self.ssthresh = max(self.cwnd / 2, 2)
+                self.cwnd = 1.0
+
+        # Колбэки вызываем уже без блокировки
+        for callback in failed:
+            callback(False)
+
+        return resend_list
 
     def _start_timer(self, seq_num):
         """Запуск таймера для пакета"""
@@ -96,63 +198,93 @@ class SlidingWindow:
         """Закрытие окна"""
         with self.lock:
             self.closed = True
-            for seq_num in list(self.packets.keys()):
-                if self.packets[seq_num].get('callback'):
-                    self.packets[seq_num]['callback'](False)
+            self._drain_acks()
+            for info in self.packets.values():
+                if info.callback:
+                    info.callback(False)
             self.packets.clear()
+            self._deadlines.clear()
 
 
 class ReceiveWindow:
     """Окно приема для упорядочивания пакетов"""
 
-    def __init__(self, window_size=10):
+    def __init__(self, window_size=10, first_seq=0):
         self.window_size = window_size
-        self.expected_seq = 0
-        self.buffer = OrderedDict()
-        self.received_packets = set()  # Для предотвращения дубликатов
+        self.first_seq = first_seq
+        self.expected_seq = first_seq
+        # Кольцо буферизованных пакетов, слот seq_num % window_size
+        self.buffer = [None] * window_size
+        # Битовая маска окна: бит i означает, что пакет expected_seq + i уже
+        # получен. Все пакеты до expected_seq получены по определению, поэтому
+        # память не растет с длиной передачи
+        self._bitmap = 0
+        # Пакетов с последнего take_sack, включая повторы уже полученных:
+        # их ACK мог потеряться, и отправителю нужен новый SACK
+        self.pending_acks = 0
 
     def add_packet(self, seq_num, total_packets, data):
         """
         Добавление полученного пакета
         Возвращает (готово_ли_к_обработке, данные_пакета)
         """
-        # Проверка на дубликат
-        if seq_num in self.received_packets:
-            return False, None
+        idx = seq_num - self.expected_seq
 
-        # Если пакет ожидаемый
-        if seq_num == self.expected_seq:
-            self.expected_seq += 1
-            self.received_packets.add(seq_num)
-
-            # Проверяем буфер на наличие следующих пакетов
-            result_data = [data]
+        # Пакет за пределами окна: SACK его не покрывает
+        if idx >= self.window_size:
+            return False, None
 
-            while self.expected_seq in self.buffer:
-                result_data.append(self.buffer.pop(self.expected_seq))
-                self.received_packets.add(self.expected_seq)
-                self.expected_seq += 1
+        # Старый пакет или дубликат
+        if idx < 0 or (self._bitmap >> idx) & 1:
+            self.pending_acks += 1
+            return False, None
 
-            return True, result_data if len(result_data) > 1 else data
+        self._bitmap |= 1 << idx
+        self.pending_acks += 1
 
         # Если пакет из будущего, сохраняем в буфер
-        elif seq_num > self.expected_seq and seq_num < self.expected_seq + self.window_size:
-            if seq_num not in self.buffer:
-                self.buffer[seq_num] = data
+        if idx:
+            self.buffer[seq_num % self.window_size] = data
             return False, None
 
-        return False, None
+        # Пакет ожидаемый: число младших единичных бит - длина непрерывного
+        # участка, который можно отдать вместе с буферизованными пакетами
+        count = (~self._bitmap & (self._bitmap + 1)).bit_length() - 1
+        result_data = [data]
+        buffer = self.buffer
+        size = self.window_size
+        for seq in range(seq_num + 1, seq_num + count):
+            slot = seq % size
+            result_data.append(buffer[slot])
+            buffer[slot] = None
+
+        self.expected_seq += count
+        self._bitmap >>= count
+
+        return True, result_data if len(result_data) > 1 else data
 
     def get_missing_packets(self):
         """Получение списка пропущенных пакетов"""
         missing = []
-        for i in range(self.expected_seq, self.expected_seq + self.window_size):
-            if i not in self.received_packets and i not in self.buffer:
-                missing.append(i)
+        # Нулевые биты окна - пропущенные пакеты; перебираем только их
+        holes = ~self._bitmap & ((1 << self.window_size) - 1)
+        while holes:
+            low = holes & -holes
+            missing.append(self.expected_seq + low.bit_length() - 1)
+            holes ^= low
         return missing
 
+    def take_sack(self):
+        """
+        Данные для create_sack_bitmap_packet: (base_seq, bitmap) - одно
+        подтверждение вместо ACK на каждый пакет с последнего вызова
+        """
+        self.pending_acks = 0
+        return self.expected_seq, self._bitmap & ((1 << SACK_BITMAP_BITS) - 1)
+
     def reset(self):
         """Сброс окна приема"""
-        self.expected_seq = 0
-        self.buffer.clear()
-        self.received_packets.clear()
\ No newline at end of file
+        self.expected_seq = self.first_seq
+        self.pending_acks = 0
+        self.buffer = [None] * self.window_size
+        self._bitmap = 0
\ No newline at end of file
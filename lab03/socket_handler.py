@@ -2,29 +2,284 @@
 Модуль для работы с сокетами с учетом особенностей TCP
 """
 
+import errno
+import io
+import logging
+import mmap
+import os
 import socket
-from app_config import BUFFER_SIZE, IS_WINDOWS, SOCKET_TIMEOUT
+import selectors
+import sys
+import threading
+import weakref
+from contextlib import contextmanager
+from app_config import (
+    BUFFER_SIZE,
+    IS_WINDOWS,
+    SOCKET_TIMEOUT,
+    TCP_SNDBUF,
+    TCP_RCVBUF,
+)
 
+_log = logging.getLogger(__name__)
 
-def set_keepalive(sock, idle=30, interval=5, count=3):
-    """Настройка TCP Keep-Alive для разных ОС"""
+# TCP_QUICKACK есть только в Linux
+HAS_QUICKACK = not IS_WINDOWS and hasattr(socket, "TCP_QUICKACK")
+
+# SO_RCVLOWAT на Windows задать нельзя
+HAS_RCVLOWAT = not IS_WINDOWS and hasattr(socket, "SO_RCVLOWAT")
+
+# TCP_USER_TIMEOUT (Linux >= 2.6.37): сколько неподтвержденные данные
+# могут висеть в очереди отправки до разрыва. Старый Python не знает
+# константу, ее номер в ядре - 18
+TCP_USER_TIMEOUT = getattr(socket, "TCP_USER_TIMEOUT", 18)
+HAS_USER_TIMEOUT = sys.platform.startswith("linux")
+
+# TCP Fast Open (Linux): данные первого send уходят вместе с SYN.
+# Номера опций в ядре: TCP_FASTOPEN = 23, TCP_FASTOPEN_CONNECT = 30
+HAS_FASTOPEN = sys.platform.startswith("linux")
+TCP_FASTOPEN = getattr(socket, "TCP_FASTOPEN", 23)
+TCP_FASTOPEN_CONNECT = getattr(socket, "TCP_FASTOPEN_CONNECT", 30)
+
+# Длина очереди запросов TFO на слушающем сокете
+FASTOPEN_QUEUE = 16
+
+# os.sendfile есть не везде (нет в Windows)
+HAS_SENDFILE = hasattr(os, "sendfile")
+
+# Верхняя граница SO_RCVLOWAT при приеме больших блоков (байт)
+RCVLOWAT_MAX = 256 * 1024
+
+# Селектор на поток для ожидания готовности неблокирующих сокетов
+_local = threading.local()
+
+# Буферизованные читатели для сокетов: sock -> io.BufferedReader
+# Все чтения из сокета должны идти через один читатель, иначе
+# прочитанные наперед байты будут потеряны
+_readers = weakref.WeakKeyDictionary()
+
+# Свободные читатели закрытых сокетов (LIFO): их буферы BUFFER_SIZE
+# переиспользуются новыми соединениями вместо новых выделений
+_reader_pool = []
+READER_POOL_SIZE = 32
+
+
+def _wait_ready(sock, events, timeout=SOCKET_TIMEOUT):
+    """Ожидание готовности сокета (epoll/kqueue) вместо активного цикла"""
+    selector = getattr(_local, "selector", None)
+    if selector is None:
+        selector = _local.selector = selectors.DefaultSelector()
+
+    selector.register(sock, events)
     try:
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        ready = selector.select(timeout)
+    finally:
+        selector.unregister(sock)
+
+    if not ready:
+        raise socket.timeout("Превышено время ожидания сокета")
+
+
+class _SocketRawIO(io.RawIOBase):
+    """Сырой поток поверх сокета для io.BufferedReader"""
 
-        if IS_WINDOWS:
+    def __init__(self):
+        self._sock = None
+
+    def attach(self, sock):
+        # Слабая ссылка, чтобы читатель не удерживал сокет в _readers
+        self._sock = weakref.proxy(sock)
+
+    def release(self):
+        self._sock = None
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        if self._sock is None:
+            return 0  # Читатель отвязан от сокета - как конец потока
+
+        while True:
             try:
-                sock.ioctl(socket.SIO_KEEPALIVE_VALS, (1, idle * 1000, interval * 1000))
-            except:
-                pass
+                return self._sock.recv_into(buf)
+            except socket.timeout:
+                # recv уже ждал SOCKET_TIMEOUT секунд, просто ждем дальше
+                continue
+            except BlockingIOError:
+                _wait_ready(self._sock, selectors.EVENT_READ)
+
+
+def _get_reader(sock):
+    """Получение (или создание) буферизованного читателя для сокета"""
+    reader = _readers.get(sock)
+    if reader is None:
+        if _reader_pool:
+            reader = _reader_pool.pop()
         else:
+            reader = io.BufferedReader(_SocketRawIO(), BUFFER_SIZE)
+        reader.raw.attach(sock)
+        _readers[sock] = reader
+        weakref.finalize(sock, _release_reader, reader)
+    return reader
+
+
+def _release_reader(reader):
+    """Возврат читателя в пул после уничтожения сокета"""
+    reader.raw.release()
+    # Читатель с непрочитанными байтами чужого соединения не переиспользуем
+    if len(_reader_pool) < READER_POOL_SIZE and not reader.peek(1):
+        _reader_pool.append(reader)
+
+
+def _read_until(reader, delimiter):
+    """Чтение до произвольного разделителя через peek() без лишних чтений"""
+    data = bytearray()
+    while True:
+        chunk = reader.peek(len(delimiter))
+        if not chunk:
+            raise ConnectionError("Соединение разорвано")
+
+        start = max(0, len(data) - len(delimiter) + 1)
+        data += chunk
+        pos = data.find(delimiter, start)
+        if pos >= 0:
+            end = pos + len(delimiter)
+            # Забираем из буфера только то, что относится к строке
+            reader.read(len(chunk) - (len(data) - end))
+            # Хвост отрезаем на месте: итоговая строка копируется один раз
+            del data[end:]
+            return bytes(data)
+
+        reader.read(len(chunk))
+
+
+def _set_keepalive_windows(sock, idle=30, interval=5, count=3):
+    """Настройка TCP Keep-Alive для Windows"""
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        try:
+            sock.ioctl(socket.SIO_KEEPALIVE_VALS, (1, idle * 1000, interval * 1000))
+        except OSError:
+            pass
+    except OSError as e:
+        _log.warning("Ошибка настройки keepalive: %s", e)
+
+
+# Опции тонкой настройки keep-alive, которые есть на этой платформе:
+# (опция, индекс значения в (idle, interval, count))
+_KEEPALIVE_OPTS = tuple(
+    (getattr(socket, name), i)
+    for i, name in enumerate(("TCP_KEEPIDLE", "TCP_KEEPINTVL", "TCP_KEEPCNT"))
+    if hasattr(socket, name)
+)
+
+
+def _set_keepalive_posix(sock, idle=30, interval=5, count=3):
+    """Настройка TCP Keep-Alive для Linux/macOS"""
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        # Тонкая настройка не обязательна: ядро может не принять опции
+        try:
+            values = (idle, interval, count)
+            for option, i in _KEEPALIVE_OPTS:
+                sock.setsockopt(socket.IPPROTO_TCP, option, values[i])
+        except OSError:
+            pass
+
+        # Мертвый собеседник обнаруживается за то же время, что и keep-alive,
+        # даже если в очереди отправки есть данные (тогда keep-alive молчит)
+        if HAS_USER_TIMEOUT:
             try:
-                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, idle)
-                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, interval)
-                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, count)
-            except:
+                sock.setsockopt(
+                    socket.IPPROTO_TCP,
+                    TCP_USER_TIMEOUT,
+                    (idle + interval * count) * 1000,
+                )
+            except OSError:
                 pass
-    except Exception as e:
-        print(f"Ошибка настройки keepalive: {e}")
+    except OSError as e:
+        _log.warning("Ошибка настройки keepalive: %s", e)
+
+
+# Реализация под текущую ОС выбирается один раз при импорте
+set_keepalive = _set_keepalive_windows if IS_WINDOWS else _set_keepalive_posix
+
+
+def set_quickack(sock):
+    """Немедленная отправка ACK (ядро сбрасывает флаг, ставить перед чтением)"""
+    if not HAS_QUICKACK:
+        return
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
+    except OSError:
+        pass
+
+
+def set_low_latency(sock):
+    """Отключение алгоритма Нейгла и отложенных ACK для команд"""
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except OSError:
+        pass
+    set_quickack(sock)
+
+
+def set_socket_buffers(sock, sndbuf=TCP_SNDBUF, rcvbuf=TCP_RCVBUF):
+    """Увеличение буферов отправки/приема сокета"""
+    for option, size in ((socket.SO_SNDBUF, sndbuf), (socket.SO_RCVBUF, rcvbuf)):
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, option, size)
+        except OSError:
+            pass
+
+
+def set_cork(sock, enabled):
+    """Включение/выключение TCP_CORK (только Linux)"""
+    if not hasattr(socket, "TCP_CORK"):
+        return
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1 if enabled else 0)
+    except OSError:
+        pass
+
+
+def set_fastopen(sock, qlen=FASTOPEN_QUEUE):
+    """
+    Прием TCP Fast Open на слушающем сокете (ставить до listen).
+    Клиентская сторона включается в create_socket
+    """
+    if not HAS_FASTOPEN:
+        return
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, TCP_FASTOPEN, qlen)
+    except OSError:
+        pass
+
+
+@contextmanager
+def cork(sock):
+    """Склеивание серии мелких отправок в полные сегменты"""
+    set_cork(sock, True)
+    try:
+        yield sock
+    finally:
+        set_cork(sock, False)
+
+
+def recv_until_bytes(sock, delimiter=b"\n"):
+    """Получение байт до разделителя (включительно)"""
+    reader = _get_reader(sock)
+    set_quickack(sock)
+
+    if delimiter == b"\n":
+        # readline ищет разделитель в буфере на стороне C
+        data = reader.readline()
+        if not data.endswith(delimiter):
+            raise ConnectionError("Соединение разорвано")
+        return data
+
+    return _read_until(reader, delimiter)
 
 
 def recv_until(sock, delimiter="\n"):
@@ -32,74 +287,214 @@ def recv_until(sock, delimiter="\n"):
     Получение ТЕКСТОВЫХ данных до разделителя
     Использовать ТОЛЬКО для команд!
     """
-    if isinstance(delimiter, str):
-        delimiter = delimiter.encode()
+    return recv_until_bytes(sock, delimiter.encode()).decode("utf-8").strip()
 
-    data = b""
-    while True:
-        try:
-            chunk = sock.recv(1)
-            if not chunk:
-                raise ConnectionError("Соединение разорвано")
 
-            data += chunk
+def _set_rcvlowat(sock, value):
+    """Минимум байт, при котором ядро будит читателя сокета"""
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVLOWAT, value)
+    except OSError:
+        pass
 
-            if data.endswith(delimiter) or data.endswith(b"\r\n"):
-                break
-        except socket.timeout:
-            continue
-        except BlockingIOError:
-            continue
 
-    return data.decode("utf-8").strip()
+def recv_exact_into(sock, view):
+    """
+    Заполнение буфера вызывающего (memoryview, bytearray, mmap) ровно
+    len(view) байтами из сокета - без промежуточных объектов bytes
+    """
+    num_bytes = len(view)
+    if num_bytes <= 0:
+        return
 
+    reader = _get_reader(sock)
+    with memoryview(view) as view:
+        # Сначала отдаются байты, уже прочитанные в буфер через recv_until.
+        # Если места хватило, после этого буфер читателя пуст
+        received = reader.readinto1(view)
+        if not received:
+            raise ConnectionError("Соединение разорвано")
 
-def recv_exact(sock, num_bytes):
-    """Получение точного количества байт (для файлов)"""
-    if num_bytes <= 0:
-        return b""
+        raw = reader.raw
 
-    data = b""
-    while len(data) < num_bytes:
+        # Остаток читаем напрямую из сокета. SO_RCVLOWAT не дает ядру
+        # будить нас ради каждого мелкого сегмента: пробуждений и recv меньше.
+        # Порог не превышает число еще не пришедших байт, иначе зависнем
+        lowat = 1
         try:
-            # Читаем не больше, чем нужно, и не больше размера буфера
-            to_read = min(num_bytes - len(data), BUFFER_SIZE)
-            chunk = sock.recv(to_read)
-            if not chunk:
-                raise ConnectionError("Соединение разорвано")
-            data += chunk
-        except socket.timeout:
-            continue
-        except BlockingIOError:
-            # Если сокет неблокирующий и данных пока нет
-            continue
+            while received < num_bytes:
+                want = min(num_bytes - received, RCVLOWAT_MAX)
+                if HAS_RCVLOWAT and want != lowat:
+                    _set_rcvlowat(sock, want)
+                    lowat = want
+
+                n = raw.readinto(view[received:])
+                if not n:
+                    raise ConnectionError("Соединение разорвано")
+                received += n
+        finally:
+            if lowat != 1:
+                _set_rcvlowat(sock, 1)
 
+
+def recv_exact(sock, num_bytes):
+    """
+    Получение точного количества байт (для файлов)
+    Возвращает bytearray, заполненный без промежуточных копий
+    """
+    data = bytearray(max(num_bytes, 0))
+    recv_exact_into(sock, data)
     return data
 
 
-def send_all(sock, data):
-    """Гарантированная отправка всех данных"""
-    if isinstance(data, str):
-        data = data.encode("utf-8")
+def send_all(sock, text):
+    """Гарантированная отправка строки (для команд и ответов)"""
+    send_bytes(sock, text.encode("utf-8"))
 
-    total_sent = 0
-    while total_sent < len(data):
+
+def send_bytes(sock, data):
+    """Гарантированная отправка всех байт"""
+    # Для блокирующего сокета (в т.ч. с таймаутом) цикл отправки выполняет
+    # sendall на стороне C
+    if sock.gettimeout() != 0.0:
         try:
-            sent = sock.send(data[total_sent:])
-            if sent == 0:
-                raise ConnectionError("Соединение разорвано")
-            total_sent += sent
-        except socket.timeout:
-            continue
+            sock.sendall(data)
+        except OSError as e:
+            raise ConnectionError(f"Ошибка сокета: {e}")
+        return
+
+    # Неблокирующий сокет: sendall не сообщает, сколько успел отправить,
+    # поэтому досылаем сами. Срезы memoryview не копируют остаток данных
+    with memoryview(data) as view:
+        total_sent = 0
+        while total_sent < len(view):
+            try:
+                sent = sock.send(view[total_sent:])
+                if sent == 0:
+                    raise ConnectionError("Соединение разорвано")
+                total_sent += sent
+            except BlockingIOError:
+                _wait_ready(sock, selectors.EVENT_WRITE)
+                continue
+            except socket.error as e:
+                raise ConnectionError(f"Ошибка сокета: {e}")
+
+
+def send_all_vec(sock, buffers):
+    """
+    Отправка нескольких буферов (заголовок + данные) одним вызовом sendmsg
+    Буферы должны быть bytes-подобными объектами
+    """
+    if not hasattr(sock, "sendmsg"):
+        # Windows: sendmsg нет, склеиваем буферы
+        send_bytes(sock, b"".join(buffers))
+        return
+
+    views = [memoryview(b) for b in buffers if len(b)]
+    while views:
+        try:
+            sent = sock.sendmsg(views)
         except BlockingIOError:
+            _wait_ready(sock, selectors.EVENT_WRITE)
             continue
-        except socket.error as e:
+        except OSError as e:
             raise ConnectionError(f"Ошибка сокета: {e}")
+        if sent == 0:
+            raise ConnectionError("Соединение разорвано")
+
+        # Отбрасываем полностью отправленные буферы, первый оставшийся обрезаем
+        while views and sent >= len(views[0]):
+            sent -= len(views.pop(0))
+        if sent:
+            views[0] = views[0][sent:]
+
+
+def _send_file_mmap(sock, f, offset, count):
+    """
+    Отправка части файла без sendfile: срезы отображения в память уходят
+    в send напрямую, без чтения в промежуточные bytes
+    """
+    size = os.fstat(f.fileno()).st_size
+    count = min(count, size - offset)
+    if count <= 0:
+        return 0
+
+    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        # Срез освобождается явно: при ошибке отправки на него ссылается
+        # traceback, и mm.close() подменил бы исходную ошибку BufferError
+        with memoryview(mm)[offset : offset + count] as part:
+            send_bytes(sock, part)
+    finally:
+        mm.close()
+    return count
+
+
+def send_file(sock, f, offset=0, count=None):
+    """
+    Отправка файла через sendfile (без копирования в пространство пользователя)
+    Возвращает число отправленных байт
+    """
+    try:
+        if count is None:
+            count = os.fstat(f.fileno()).st_size - offset
+
+        if not HAS_SENDFILE:
+            sent = _send_file_mmap(sock, f, offset, count)
+            f.seek(offset + sent)
+            return sent
+
+        if sock.gettimeout() != 0.0:
+            return sock.sendfile(f, offset, count)
+
+        # socket.sendfile не принимает неблокирующие сокеты
+        total_sent = 0
+        while total_sent < count:
+            try:
+                sent = os.sendfile(
+                    sock.fileno(), f.fileno(), offset + total_sent,
+                    count - total_sent,
+                )
+            except BlockingIOError:
+                _wait_ready(sock, selectors.EVENT_WRITE)
+                continue
+            if sent == 0:
+                break  # Файл закончился раньше
+            total_sent += sent
+
+        f.seek(offset + total_sent)
+        return total_sent
+    except OSError as e:
+        raise ConnectionError(f"Ошибка сокета: {e}")
 
 
 def create_socket():
-    """Создание TCP сокета"""
+    """
+    Создание TCP сокета
+    Сокет неблокирующий: с settimeout Python делает poll перед каждым
+    recv/send, а так ожидание (_wait_ready) нужно только при EAGAIN.
+    Подключать через connect_socket
+    """
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    sock.settimeout(SOCKET_TIMEOUT)
+    sock.setblocking(False)
     sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if HAS_FASTOPEN:
+        # С cookie от сервера первая команда уходит в SYN: минус один RTT.
+        # Без cookie (или без поддержки на сервере) - обычное рукопожатие
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, TCP_FASTOPEN_CONNECT, 1)
+        except OSError:
+            pass
+    set_socket_buffers(sock)
+    set_low_latency(sock)
     return sock
+
+
+def connect_socket(sock, address, timeout=SOCKET_TIMEOUT):
+    """Неблокирующее подключение с ограничением времени ожидания"""
+    err = sock.connect_ex(address)
+    if err in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY):
+        _wait_ready(sock, selectors.EVENT_WRITE, timeout)
+        err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+    if err:
+        raise OSError(err, os.strerror(err))
@@ -0,0 +1,87 @@
+"""
+Проверка SACK при загрузке по UDP: потеря пакета, когда в полете больше
+пакетов, чем покрывает маска
+"""
+import contextlib
+import io
+import unittest
+
+from server import UDPServerHandler
+from udp_handler import (
+    create_ack_packet,
+    parse_packet,
+    FLAG_DATA,
+    FLAG_SACK_BITMAP,
+    DATA_FIRST_SEQ,
+    SACK_BITMAP_BITS,
+)
+from sliding_window import ReceiveWindow
+
+
+class _FakeSocket:
+    def __init__(self):
+        self.sent = []
+
+    def sendto(self, packet, addr):
+        self.sent.append(bytes(packet))
+
+
+class _FakeServer:
+    def __init__(self):
+        self.udp_socket = _FakeSocket()
+
+
+class SackUploadTest(unittest.TestCase):
+    def setUp(self):
+        self.server = _FakeServer()
+        self.handler = UDPServerHandler(self.server)
+        self.addr = ("127.0.0.1", 1)
+        self.client_info = {
+            "file_session": {
+                "filename": "f.bin",
+                "filesize": 10**9,
+                "received": 0,
+                "packets": {},
+                "start_time": 0,
+                "ack_window": ReceiveWindow(SACK_BITMAP_BITS, DATA_FIRST_SEQ),
+            }
+        }
+
+    def _receive(self, seqs):
+        with contextlib.redirect_stdout(io.StringIO()):
+            for seq in seqs:
+                self.handler._handle_file_data(
+                    self.addr, self.client_info, seq, 10**6, FLAG_DATA, b"x"
+                )
+
+    def _individual_acks(self):
+        return [
+            p for p in self.server.udp_socket.sent
+            if not parse_packet(p)[2] & FLAG_SACK_BITMAP
+        ]
+
+    def test_loss_with_more_than_mask_in_flight(self):
+        lost = DATA_FIRST_SEQ + 10
+        in_flight = SACK_BITMAP_BITS + 50
+        self._receive(
+            seq for seq in range(DATA_FIRST_SEQ, DATA_FIRST_SEQ + in_flight)
+            if seq != lost
+        )
+        # Пакеты за маской подтверждены по одному
+        self.assertIn(create_ack_packet(DATA_FIRST_SEQ + in_flight - 1),
+                      self._individual_acks())
+
+        # Повтор закрывает дыру: граница SACK догоняет все принятые пакеты
+        self._receive([lost])
+        ack_window = self.client_info["file_session"]["ack_window"]
+        self.assertEqual(ack_window.expected_seq, DATA_FIRST_SEQ + in_flight)
+
+        # Дальше пакеты снова подтверждаются только SACK
+        before = len(self._individual_acks())
+        self._receive(range(DATA_FIRST_SEQ + in_flight, DATA_FIRST_SEQ + in_flight + 200))
+        self.assertEqual(len(self._individual_acks()), before)
+        self.assertEqual(ack_window.expected_seq, DATA_FIRST_SEQ + in_flight + 200)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,15 +1,22 @@
 """
 Модуль для работы с UDP сокетами
 """
+import errno
+import logging
 import socket
 import struct
+import sys
 import time
 from app_config import BUFFER_SIZE
 
 # Заголовок пакета: magic(2) + packet_id(4) + total_packets(4) + flags(1) + data_size(2)
 PACKET_HEADER_FORMAT = '!HIIBH'
 PACKET_HEADER_SIZE = struct.calcsize(PACKET_HEADER_FORMAT)
+# Формат разбирается один раз, а не при каждом struct.pack
+PACKET_HEADER = struct.Struct(PACKET_HEADER_FORMAT)
 MAGIC = 0xDEAD
+# Первые байты любого пакета: чужие датаграммы отсеиваются без разбора заголовка
+MAGIC_BYTES = MAGIC.to_bytes(2, "big")
 
 # Флаги пакета
 FLAG_DATA = 0x01
@@ -17,67 +24,211 @@ FLAG_ACK = 0x02
 FLAG_START = 0x04
 FLAG_END = 0x08
 FLAG_RESEND = 0x10
+FLAG_SACK_BITMAP = 0x40  # packet_id - граница, данные - битовая маска после нее
+
+# Номер первого пакета данных файла (меньшие номера - команды)
+DATA_FIRST_SEQ = 1000
+
+# Буфер приема одной датаграммы (байт). Пакеты не больше 1400 байт:
+# команды и файлы сами делятся на пакеты, поэтому 2048 хватает
+MAX_DATAGRAM = 2048
+
+# UDP GSO (Linux >= 4.18): ядро само режет буфер на датаграммы
+# одного размера, серия пакетов уходит одним sendmsg
+SOL_UDP = getattr(socket, "SOL_UDP", 17)
+UDP_SEGMENT = getattr(socket, "UDP_SEGMENT", 103)
+GSO_MAX_SEGMENTS = 64
+GSO_MAX_BYTES = 65000
+_gso_enabled = sys.platform.startswith("linux") and hasattr(socket.socket, "sendmsg")
+# Ошибки sendmsg, означающие, что GSO не поддерживается ядром или картой
+GSO_UNSUPPORTED_ERRNOS = {errno.EIO, errno.EINVAL, errno.ENOPROTOOPT, errno.EOPNOTSUPP}
+# Временная нехватка места в буфере отправки: пакет надо отправить позже
+SEND_RETRY_ERRNOS = {errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOBUFS}
+
+# Буферы UDP сокета (байт). Ядро ограничит их rmem_max/wmem_max, поэтому
+# фактический размер надо смотреть через getsockopt
+UDP_BUFFER_SIZE = 8 * 1024 * 1024
+HAS_REUSEPORT = hasattr(socket, "SO_REUSEPORT")
 
 # Таймауты (сек)
 ACK_TIMEOUT = 0.5
 MAX_RESENDS = 5
 
+_log = logging.getLogger(__name__)
+
+# Отброшенные пакеты не печатаются по одному: под потоком мусора вывод
+# на каждый пакет тормозил бы прием. Сводка - не чаще раза в интервал (сек)
+BAD_PACKET_LOG_INTERVAL = 10.0
+_bad_packets = 0
+_bad_packets_logged = 0.0
+
 
 def create_packet(packet_id, total_packets, flags, data=b''):
     """
     Создание пакета с заголовком
     Формат: [magic(2)][packet_id(4)][total_packets(4)][flags(1)][data_size(2)][data]
     """
-    header = struct.pack(
-        PACKET_HEADER_FORMAT,
-        MAGIC,
-        packet_id,
-        total_packets,
-        flags,
-        len(data)
-    )
+    header = PACKET_HEADER.pack(MAGIC, packet_id, total_packets, flags, len(data))
     return header + data
 
 
+def pack_header_into(buffer, packet_id, total_packets, flags, data_size):
+    """
+    Запись заголовка в начало готового буфера пакета, данные уже лежат
+    за заголовком. Для отправки в цикле через один переиспользуемый буфер
+    """
+    PACKET_HEADER.pack_into(buffer, 0, MAGIC, packet_id, total_packets, flags, data_size)
+
+
+def _reject_packet(reason, *args):
+    """Учет отброшенного пакета; всегда возвращает None"""
+    global _bad_packets, _bad_packets_logged
+    _log.debug(reason, *args)
+    _bad_packets += 1
+    now = time.monotonic()
+    if now - _bad_packets_logged >= BAD_PACKET_LOG_INTERVAL:
+        _log.warning("Отброшено некорректных UDP пакетов: %d", _bad_packets)
+        _bad_packets = 0
+        _bad_packets_logged = now
+    return None
+
+
 def parse_packet(packet):
     """Разбор пакета и возврат (packet_id, total_packets, flags, data)"""
     if len(packet) < PACKET_HEADER_SIZE:
-        print(f"Пакет слишком короткий: {len(packet)} < {PACKET_HEADER_SIZE}")
-        return None
+        return _reject_packet("Пакет слишком короткий: %d < %d", len(packet), PACKET_HEADER_SIZE)
+
+    if packet[:2] != MAGIC_BYTES:
+        return _reject_packet("Неверное магическое число: %r", bytes(packet[:2]))
 
     try:
-        header = packet[:PACKET_HEADER_SIZE]
-        magic, packet_id, total_packets, flags, data_size = struct.unpack(PACKET_HEADER_FORMAT, header)
+        # unpack_from читает заголовок на месте, без среза-копии
+        _, packet_id, total_packets, flags, data_size = PACKET_HEADER.unpack_from(packet)
 
-        if magic != MAGIC:
-            print(f"Неверное магическое число: {magic} != {MAGIC}")
-            return None
+        # Обрезанный пакет отбрасывается: неполные данные молча испортили бы
+        # файл или команду
+        payload_end = PACKET_HEADER_SIZE + data_size
+        if payload_end > len(packet):
+            return _reject_packet(
+                "Размер данных не соответствует: %d < %d",
+                len(packet) - PACKET_HEADER_SIZE,
+                data_size,
+            )
 
-        data = packet[PACKET_HEADER_SIZE:PACKET_HEADER_SIZE + data_size]
+        return packet_id, total_packets, flags, packet[PACKET_HEADER_SIZE:payload_end]
 
-        # Проверяем, что данные соответствуют заявленному размеру
-        if len(data) != data_size:
-            print(f"Размер данных не соответствует: {len(data)} != {data_size}")
-            # Пытаемся взять сколько есть
-            data = packet[PACKET_HEADER_SIZE:]
+    except Exception as e:
+        return _reject_packet("Ошибка парсинга пакета: %s", e)
 
-        return packet_id, total_packets, flags, data
 
-    except Exception as e:
-        print(f"Ошибка парсинга пакета: {e}")
-        return None
+def recv_packet(sock, buffer):
+    """
+    Прием датаграммы в готовый буфер (bytearray(MAX_DATAGRAM)) и ее разбор
+    Возвращает (разобранный пакет или None, адрес). Данные пакета - срез
+    буфера: если они нужны после следующего приема, их надо скопировать
+    """
+    nbytes, addr = sock.recvfrom_into(buffer)
+    return parse_packet(memoryview(buffer)[:nbytes]), addr
 
 
 def create_ack_packet(packet_id):
     """Создание ACK пакета"""
-    return create_packet(packet_id, 0, FLAG_ACK)
+    # ACK отличается только packet_id: один pack без данных и без склейки
+    return PACKET_HEADER.pack(MAGIC, packet_id, 0, FLAG_ACK, 0)
+
 
+# Битовая маска SACK: бит i подтверждает пакет base_seq + i. Ширина маски
+# не меньше максимального окна клиента, иначе пакеты за маской пришлось бы
+# подтверждать по одному
+SACK_BITMAP_BITS = 256
+SACK_BITMAP_BYTES = SACK_BITMAP_BITS // 8
+# Получатель шлет SACK после стольких новых пакетов, а остаток - когда
+# очередь сокета опустела
+SACK_EVERY = 16
 
-def create_udp_socket():
-    """Создание UDP сокета"""
+
+def create_sack_bitmap_packet(base_seq, bitmap):
+    """
+    Кумулятивное подтверждение: все пакеты до base_seq получены,
+    из следующих SACK_BITMAP_BITS - отмеченные битами bitmap
+    """
+    payload = (bitmap & ((1 << SACK_BITMAP_BITS) - 1)).to_bytes(SACK_BITMAP_BYTES, "big")
+    return create_packet(base_seq, 0, FLAG_ACK | FLAG_SACK_BITMAP, payload)
+
+
+def parse_sack_bitmap(base_seq, data):
+    """Номера пакетов, отмеченных битами SACK пакета с FLAG_SACK_BITMAP"""
+    bitmap = int.from_bytes(data[:SACK_BITMAP_BYTES], "big")
+    ids = []
+    while bitmap:
+        low = bitmap & -bitmap
+        ids.append(base_seq + low.bit_length() - 1)
+        bitmap ^= low
+    return ids
+
+
+def _send_segmented(sock, batch, addr):
+    """Отправка пакетов одного размера (кроме последнего) одним вызовом"""
+    global _gso_enabled
+    if _gso_enabled and len(batch) > 1:
+        segment = struct.pack("=H", len(batch[0]))
+        try:
+            sock.sendmsg([b"".join(batch)], [(SOL_UDP, UDP_SEGMENT, segment)], 0, addr)
+            return
+        except OSError as e:
+            # EAGAIN/ENOBUFS на неблокирующем сокете - не повод отключать GSO,
+            # их обрабатывает вызывающий код
+            if e.errno not in GSO_UNSUPPORTED_ERRNOS:
+                raise
+            # Ядро или сетевая карта не поддерживают GSO - больше не пробуем
+            _gso_enabled = False
+
+    for packet in batch:
+        sock.sendto(packet, addr)
+
+
+def send_packets(sock, packets, addr):
+    """
+    Отправка серии пакетов на один адрес
+    Подряд идущие пакеты равного размера склеиваются в один sendmsg (UDP GSO)
+    На неблокирующем сокете при заполненном буфере бросает OSError с errno
+    из SEND_RETRY_ERRNOS; часть пакетов к этому моменту уже может быть отправлена
+    """
+    batch = []
+    size = 0
+    for packet in packets:
+        if batch and (
+            len(packet) > len(batch[0])
+            or len(batch[-1]) != len(batch[0])
+            or len(batch) >= GSO_MAX_SEGMENTS
+            or size + len(packet) > GSO_MAX_BYTES
+        ):
+            _send_segmented(sock, batch, addr)
+            batch = []
+            size = 0
+        batch.append(packet)
+        size += len(packet)
+
+    if batch:
+        _send_segmented(sock, batch, addr)
+
+
+def create_udp_socket(reuseport=False):
+    """
+    Создание UDP сокета
+    reuseport=True позволяет нескольким процессам занять один порт:
+    ядро распределяет клиентов между сокетами по адресам
+    """
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuseport and HAS_REUSEPORT:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     # Увеличиваем буфер для UDP
-    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1024 * 1024)
-    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1024 * 1024)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, UDP_BUFFER_SIZE)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, UDP_BUFFER_SIZE)
+    _log.debug(
+        "Буферы UDP сокета: прием %d, отправка %d",
+        sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF),
+        sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF),
+    )
     return sock
\ No newline at end of file
@@ -9,7 +9,6 @@ import os
 import shutil
 import select
 from datetime import datetime
-from unittest import result
 from queue import Queue
 
 from app_config import *
@@ -9,7 +9,11 @@ from app_config import BUFFER_SIZE
 # Заголовок пакета: magic(2) + packet_id(4) + total_packets(4) + flags(1) + data_size(2)
 PACKET_HEADER_FORMAT = '!HIIBH'
 PACKET_HEADER_SIZE = struct.calcsize(PACKET_HEADER_FORMAT)
+# Формат разбирается один раз, а не при каждом struct.pack/unpack
+PACKET_HEADER = struct.Struct(PACKET_HEADER_FORMAT)
 MAGIC = 0xDEAD
+# Первые байты любого пакета: чужие датаграммы отсеиваются без разбора заголовка
+MAGIC_BYTES = MAGIC.to_bytes(2, "big")
 
 # Флаги пакета
 FLAG_DATA = 0x01
@@ -28,14 +32,7 @@ def create_packet(packet_id, total_packets, flags, data=b''):
     Создание пакета с заголовком
     Формат: [magic(2)][packet_id(4)][total_packets(4)][flags(1)][data_size(2)][data]
     """
-    header = struct.pack(
-        PACKET_HEADER_FORMAT,
-        MAGIC,
-        packet_id,
-        total_packets,
-        flags,
-        len(data)
-    )
+    header = PACKET_HEADER.pack(MAGIC, packet_id, total_packets, flags, len(data))
     return header + data
 
 
@@ -45,13 +42,13 @@ def parse_packet(packet):
         print(f"Пакет слишком короткий: {len(packet)} < {PACKET_HEADER_SIZE}")
         return None
 
-    try:
-        header = packet[:PACKET_HEADER_SIZE]
-        magic, packet_id, total_packets, flags, data_size = struct.unpack(PACKET_HEADER_FORMAT, header)
+    if packet[:2] != MAGIC_BYTES:
+        print(f"Неверное магическое число: 0x{bytes(packet[:2]).hex()} != {MAGIC:#x}")
+        return None
 
-        if magic != MAGIC:
-            print(f"Неверное магическое число: {magic} != {MAGIC}")
-            return None
+    try:
+        # unpack_from читает заголовок на месте, без среза-копии
+        _, packet_id, total_packets, flags, data_size = PACKET_HEADER.unpack_from(packet)
 
         data = packet[PACKET_HEADER_SIZE:PACKET_HEADER_SIZE + data_size]
 
@@ -70,7 +67,8 @@ def parse_packet(packet):
 
 def create_ack_packet(packet_id):
     """Создание ACK пакета"""
-    return create_packet(packet_id, 0, FLAG_ACK)
+    # ACK отличается только packet_id: один pack без данных и без склейки
+    return PACKET_HEADER.pack(MAGIC, packet_id, 0, FLAG_ACK, 0)
 
 
 def create_udp_socket():